@@ -6,15 +6,170 @@ Calculate the mean phred score for each base position in a fastq file.
 
 # IMPORTS
 import argparse as ap
+import logging
 import multiprocessing as mp
+import os
+import pickle
 import sys
-import warnings
+import threading
+import time
+from multiprocessing import shared_memory
 
 import numpy as np
-import pandas as pd
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from phredlib import BatchSizer, PhredAccumulator  # noqa: E402
+from phredlib.bgzf import open_fastq  # noqa: E402
+from phredlib.reader import (  # noqa: E402
+    accumulate_range,
+    is_mappable,
+    open_range_reader,
+)
+from phredlib.tuning import (  # noqa: E402
+    adaptive_batches,
+    adaptive_ranges,
+    parse_batch_size,
+)
+
+# the first batches are this small while the batch size is tuned
+PROBE_READS = 1000
+PROBE_BYTES = 1024 * 1024
+# default size of the byte ranges of mapped files, unless it is tuned
+RANGE_SIZE = 8 * 1024 * 1024
 
 
 # CLASSES
+class SharedSlots:
+    """
+    A shared memory block in which every pool worker owns a slot holding
+    the per-position sums and counts of each input file. The parent only
+    reduces the slots once, after all tasks are done.
+    """
+
+    # the slots of the current worker process, set by attach()
+    worker_slot = None
+
+    def __init__(self, num_files, num_workers, capacity):
+        self.shape = (num_workers, num_files, 2, capacity)
+        size = int(np.prod(self.shape)) * np.dtype(np.int64).itemsize
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.array = np.ndarray(self.shape, np.int64, self.memory.buf)
+        self.array[:] = 0
+        self.counter = mp.Value("i", 0)
+
+    def initargs(self):
+        """
+        The arguments for attach() in the pool initializer
+        :return: A tuple of the block name, its shape and the slot counter
+        """
+        return self.memory.name, self.shape, self.counter
+
+    @staticmethod
+    def attach(name, shape, counter):
+        """
+        Pool initializer: claim the next free slot for this worker
+        :param name: The name of the shared memory block
+        :param shape: The shape of the block
+        :param counter: A shared counter of the slots handed out so far
+        """
+        with counter.get_lock():
+            slot = counter.value
+            counter.value += 1
+        if slot >= shape[0]:
+            raise RuntimeError("No free shared memory slot for this worker")
+        memory = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, np.int64, memory.buf)
+        # keep the block itself alive as long as the view is used
+        SharedSlots.worker_slot = (memory, array[slot])
+
+    @staticmethod
+    def add(index, accumulator):
+        """
+        Add an accumulator to the slot of this worker
+        :param index: The index of the input file
+        :param accumulator: The PhredAccumulator to add
+        :return: The part of the accumulator that does not fit, or None
+        """
+        slot = SharedSlots.worker_slot[1][index]
+        capacity = slot.shape[1]
+        size = min(len(accumulator), capacity)
+        slot[0, :size] += accumulator.sums[:size]
+        slot[1, :size] += accumulator.counts[:size]
+        if len(accumulator) <= capacity:
+            return None
+        # reads longer than the slot go back the regular way
+        accumulator.sums[:capacity] = 0
+        accumulator.counts[:capacity] = 0
+        return accumulator
+
+    def reduce(self, index):
+        """
+        Sum the slots of all workers for one input file
+        :param index: The index of the input file
+        :return: A PhredAccumulator with the total of all workers
+        """
+        file_slots = self.array[:, index].sum(axis=0)
+        return PhredAccumulator(file_slots[0], file_slots[1]).trim()
+
+    def close(self):
+        """
+        Release and remove the shared memory block
+        """
+        del self.array
+        self.memory.close()
+        self.memory.unlink()
+
+
+class IpcCounter:
+    """
+    Count the pickled bytes of tasks and results that go through the pool.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+
+    @staticmethod
+    def size(item):
+        """
+        Return the pickled size of an item
+        :param item: Any picklable object
+        :return: The number of bytes
+        """
+        return len(pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def count_sent(self, items):
+        """
+        Count the tasks sent to the pool while passing them on
+        :param items: An iterable of tasks
+        :return: A generator of the same tasks
+        """
+        for item in items:
+            self.sent += self.size(item)
+            yield item
+
+    def count_received(self, results):
+        """
+        Count the results returned by the pool while passing them on
+        :param results: An iterable of results
+        :return: A generator of the same results
+        """
+        for result in results:
+            self.received += self.size(result)
+            yield result
+
+    def report(self):
+        """
+        Print the totals to stderr
+        """
+        print(
+            f"IPC bytes sent: {self.sent}, received: {self.received}",
+            file=sys.stderr,
+        )
+
+
 class MeanPhredCalculator:
     """
     A class to calculate the mean phred score of a fastq file.
@@ -22,6 +177,7 @@ class MeanPhredCalculator:
 
     def __init__(self):
         self.args = self.parse_args()
+        self.sizers = {}
 
     @staticmethod
     def parse_args():
@@ -57,9 +213,66 @@ class MeanPhredCalculator:
         arg_parser.add_argument(
             "fastq_files",
             action="store",
-            type=ap.FileType("r"),
+            type=ap.FileType("rb"),
             nargs="+",
-            help="Minstens 1 Illumina Fastq Format file om te verwerken",
+            help="Minstens 1 Illumina Fastq Format file om te verwerken, "
+            "eventueel gecomprimeerd met gzip of bgzip",
+        )
+        # Add argument for the number of batches that may be in flight
+        arg_parser.add_argument(
+            "--in-flight",
+            action="store",
+            dest="in_flight",
+            type=int,
+            required=False,
+            help="Maximaal aantal batches dat tegelijk onderweg is. Default "
+            "is 2 keer het aantal cores",
+        )
+        # Add argument for the batch size
+        arg_parser.add_argument(
+            "-b",
+            "--batch-size",
+            action="store",
+            dest="batch_size",
+            type=parse_batch_size,
+            default=5000,
+            help="Aantal reads per batch bij pipes en gzip streams, of 'auto' "
+            "om de batch grootte en de --range-size af te stemmen op de "
+            "gemeten rekentijd en overhead. Default is 5000",
+        )
+        # Add argument for the size of the byte ranges of mapped files
+        arg_parser.add_argument(
+            "--range-size",
+            action="store",
+            dest="range_size",
+            type=int,
+            default=RANGE_SIZE,
+            help="Aantal bytes per byte range die workers zelf uit gewone "
+            "en bgzip bestanden lezen, tenzij -b auto is. Default is 8 MB",
+        )
+        # Add arguments for the shared memory result transport
+        arg_parser.add_argument(
+            "--shared-memory",
+            action="store_true",
+            dest="shared_memory",
+            help="Laat workers hun resultaten in shared memory optellen in "
+            "plaats van ze terug te sturen",
+        )
+        arg_parser.add_argument(
+            "--max-length",
+            action="store",
+            dest="max_length",
+            type=int,
+            default=1024,
+            help="Aantal base posities per worker in shared memory. Langere "
+            "reads worden gewoon teruggestuurd. Default is 1024",
+        )
+        arg_parser.add_argument(
+            "--ipc-stats",
+            action="store_true",
+            dest="ipc_stats",
+            help="Tel het aantal bytes dat tussen de processen verstuurd "
+            "wordt",
         )
 
         return arg_parser.parse_args()
@@ -67,14 +280,11 @@ class MeanPhredCalculator:
     @staticmethod
     def read_phreds(file):
         """
-        Return the PHRED scores from a FASTQ file as a list of Numpy arrays.
+        Yield the PHRED lines of a FASTQ file one at a time as bytes.
         """
-        phred_scores = []
         for i, line in enumerate(file):
             if i % 4 == 3:
-                phred_scores.append(line.strip())
-
-        return phred_scores
+                yield line.strip()
 
     @staticmethod
     def batch_iterator(iterator, batch_size):
@@ -101,56 +311,155 @@ class MeanPhredCalculator:
             yield batch
 
     @staticmethod
-    def calculate_means_from_batch(batch):
+    def calculate_sums_from_batch(batch):
+        """
+        Calculate the per-position phred sums and counts of a batch of records
+        :param batch: A batch of quality lines as bytes
+        :return: A PhredAccumulator holding the sums and counts of the batch
+        """
+        return PhredAccumulator.from_batch(batch)
+
+    @staticmethod
+    def calculate_sums_from_range(file_range):
         """
-        Calculate the means of the phred score from a batch of records
-        :param batch: A batch of records
-        :return: A list of the mean phred scores for each base position in the records
+        Calculate the per-position phred sums and counts of a byte range
+        :param file_range: A (path, offset, length) tuple of complete records
+        :return: A PhredAccumulator holding the sums and counts of the range
         """
-        ascii_dict = {chr(i): i - 33 for i in range(33, 127)}
-        max_length = max(len(line) for line in batch)
-        phreds = []
+        return accumulate_range(*file_range)
 
-        for phred_line in batch:
-            phreds_num = np.full((max_length,), np.nan)
-            for i, character in enumerate(phred_line):
-                phreds_num[i] = ascii_dict[character]
-            phreds.append(phreds_num)
+    @staticmethod
+    def imap_bounded(pool, function, iterable, in_flight):
+        """
+        Like pool.imap_unordered, but the input is only read while fewer
+        than in_flight tasks are waiting for their result. Reading and
+        computing overlap while memory stays capped at in_flight batches.
+        :param pool: A multiprocessing pool
+        :param function: The function to apply to every item
+        :param iterable: The (lazy) input items
+        :param in_flight: The maximum number of unfinished tasks
+        :return: A generator of results in order of completion
+        """
+        slots = threading.Semaphore(in_flight)
+        stopped = threading.Event()
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            with np.errstate(invalid="ignore"):
-                return np.nanmean(phreds, axis=0)
+        def throttled():
+            for item in iterable:
+                slots.acquire()  # pylint: disable=consider-using-with
+                if stopped.is_set():
+                    return
+                yield item
+
+        try:
+            for result in pool.imap_unordered(function, throttled()):
+                slots.release()
+                yield result
+        finally:
+            # after a failed task the task handler of the pool may wait
+            # for a slot, and pool.terminate() joins it
+            stopped.set()
+            slots.release()
+
+    @staticmethod
+    def run_task(task):
+        """
+        Run a single task in a worker process
+        :param task: A (file index, function, argument) tuple
+        :return: A (file index, PhredAccumulator, compute time) tuple
+        """
+        index, function, argument = task
+        start = time.perf_counter()
+        result = function(argument)
+        return index, result, time.perf_counter() - start
 
     @staticmethod
-    def calculate_total_means(means_per_batch):
+    def run_task_shared(task):
+        """
+        Run a single task in a worker process and add the result to the
+        shared memory slot of the worker instead of sending it back
+        :param task: A (file index, function, argument) tuple
+        :return: A (file index, overflow, compute time) tuple, overflow is
+        usually None
         """
-        Calculate the total mean phred score per base position from a list of means per batch
-        :param means_per_batch: A list of means per batch
-        :return: The total mean phred score
+        index, function, argument = task
+        start = time.perf_counter()
+        overflow = SharedSlots.add(index, function(argument))
+        return index, overflow, time.perf_counter() - start
+
+    def make_tasks(self):
+        """
+        Lazily create the tasks for all input files, so a single pool can
+        work on every file at once. Mapped files are cut into byte ranges
+        of --range-size bytes, BGZF files into runs of blocks that the
+        workers decompress themselves. Streams, plain gzip included, are
+        read line by line in batches. With an 'auto' batch size every file
+        gets a BatchSizer in self.sizers.
+        :return: A generator of (file index, function, argument) tuples
         """
-        total_means = np.vstack(means_per_batch)
-        means = total_means.mean(axis=0)
-        means = means[~np.isnan(means)]
-        return means
+        auto = self.args.batch_size == "auto"
+        for index, file in enumerate(self.args.fastq_files):
+            if is_mappable(file):
+                with open_range_reader(file.name) as reader:
+                    if auto:
+                        self.sizers[index] = BatchSizer(
+                            PROBE_BYTES, self.args.n, reader.size, "bytes"
+                        )
+                        ranges = adaptive_ranges(reader, self.sizers[index])
+                    else:
+                        ranges = reader.ranges(self.args.range_size)
+                    for offset, length in ranges:
+                        yield (
+                            index,
+                            self.calculate_sums_from_range,
+                            (file.name, offset, length),
+                        )
+            else:
+                # pipes and gzip streams can not be split, so read them
+                # line by line
+                records = self.read_phreds(open_fastq(file))
+                if auto:
+                    self.sizers[index] = BatchSizer(PROBE_READS, self.args.n)
+                    batches = adaptive_batches(records, self.sizers[index])
+                else:
+                    batches = self.batch_iterator(
+                        records, self.args.batch_size
+                    )
+                for batch in batches:
+                    yield index, self.calculate_sums_from_batch, batch
 
-    def write_to_csv(self, total_means):
+    def make_data_frame(self, results):
+        """
+        Put the mean phred scores of every input file in a data frame
+        :param results: A list with an array of means for every input file
+        :return: A data frame, keyed by file name if there are several files
+        """
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
+        if len(results) == 1:
+            return pd.DataFrame(results[0])
+        return pd.concat(
+            {
+                file.name: pd.DataFrame(means)
+                for file, means in zip(self.args.fastq_files, results)
+            }
+        )
+
+    def write_to_csv(self, results):
         """
         Write the total means to a csv file
 
-        :param total_means: An array of the total means
+        :param results: A list with an array of means for every input file
         """
-        data_frame = pd.DataFrame(total_means)
+        data_frame = self.make_data_frame(results)
         data_frame.to_csv(self.args.csvfile, header=False)
 
-    @staticmethod
-    def write_to_stdout(total_means):
+    def write_to_stdout(self, results):
         """
         Write the total means to stdout
 
-        :param total_means: An array of the total means
+        :param results: A list with an array of means for every input file
         """
-        data_frame = pd.DataFrame(total_means)
+        data_frame = self.make_data_frame(results)
         data_frame.to_csv(sys.stdout, header=False)
 
 
@@ -162,24 +471,61 @@ def main():
     """
     Main function
     """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     mpc = MeanPhredCalculator()
-    for file in mpc.args.fastq_files:
-        print("reading file")
-        records = mpc.read_phreds(file)
-        print("Calculating batches")
-        batches = list(mpc.batch_iterator(records, 5000))
-        print("Calculating means")
-        with mp.Pool(mpc.args.n) as pool:
-            means_per_batch = pool.map(mpc.calculate_means_from_batch, batches)
-        # print(f"means_per_batch: {means_per_batch}")
-        print("calculating total means")
-        total_means = mpc.calculate_total_means(means_per_batch)
-
-        print("writing to csv")
-        if mpc.args.csvfile:
-            mpc.write_to_csv(total_means)
-        else:
-            mpc.write_to_stdout(total_means)
+    in_flight = mpc.args.in_flight or 2 * mpc.args.n
+    totals = [PhredAccumulator() for _ in mpc.args.fastq_files]
+    counter = IpcCounter()
+    tasks = mpc.make_tasks()
+    if mpc.args.ipc_stats:
+        tasks = counter.count_sent(tasks)
+
+    slots = None
+    run_task, initializer, initargs = mpc.run_task, None, ()
+    if mpc.args.shared_memory:
+        slots = SharedSlots(
+            len(mpc.args.fastq_files), mpc.args.n, mpc.args.max_length
+        )
+        run_task = mpc.run_task_shared
+        initializer, initargs = SharedSlots.attach, slots.initargs()
+
+    print("Calculating sums")
+    # one pool for all files, so small files do not leave cores idle
+    with mp.Pool(mpc.args.n, initializer, initargs) as pool:
+        results = mpc.imap_bounded(pool, run_task, tasks, in_flight)
+        if mpc.args.ipc_stats:
+            results = counter.count_received(results)
+        try:
+            for index, task_sums, compute_time in results:
+                if task_sums is not None:
+                    totals[index].merge(task_sums)
+                sizer = mpc.sizers.get(index)
+                if sizer is not None and sizer.probing:
+                    sizer.record(compute_time)
+        except BaseException:
+            # the task handler of the pool may wait for the result of a
+            # probe batch that never comes
+            for sizer in mpc.sizers.values():
+                sizer.cancel()
+            if slots is not None:
+                slots.close()
+            raise
+
+    if slots is not None:
+        for index, total in enumerate(totals):
+            total.merge(slots.reduce(index))
+        slots.close()
+    if mpc.args.ipc_stats:
+        counter.report()
+
+    print("calculating total means")
+    results = [total.means() for total in totals]
+
+    print("writing to csv")
+    if mpc.args.csvfile:
+        mpc.write_to_csv(results)
+    else:
+        mpc.write_to_stdout(results)
 
 
 if __name__ == "__main__":
@@ -6,14 +6,39 @@ Module Docstring
 
 # IMPORTS
 import argparse as ap
+import collections
+import json
+import logging
 import multiprocessing as mp
+import os
 import queue
+import socket
 import sys
+import threading
 import time
 from multiprocessing.managers import BaseManager
 
-import numpy as np
-import pandas as pd
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from phredlib import BatchSizer, PhredAccumulator  # noqa: E402
+from phredlib.bgzf import open_fastq  # noqa: E402
+from phredlib.reader import (  # noqa: E402
+    accumulate_range,
+    is_mappable,
+    open_range_reader,
+)
+from phredlib.tuning import (  # noqa: E402
+    adaptive_batches,
+    adaptive_ranges,
+    parse_batch_size,
+)
+
+# the first batches are this small while the batch size is tuned
+PROBE_READS = 1000
+PROBE_BYTES = 1024 * 1024
+# default size of the byte ranges clients read themselves, unless it is tuned
+RANGE_SIZE = 8 * 1024 * 1024
 
 
 def parse_args():
@@ -40,6 +65,11 @@ def parse_args():
         action="store_true",
         help="Run the program in Client mode; see extra options needed below",
     )
+    client_server_mode.add_argument(
+        "--status",
+        action="store_true",
+        help="Toon de voortgang en doorvoer van een draaiende server als JSON",
+    )
 
     # server args
     server_args = arg_parser.add_argument_group(
@@ -60,17 +90,75 @@ def parse_args():
     server_args.add_argument(
         "fastq_files",
         action="store",
-        type=ap.FileType("r"),
+        type=ap.FileType("rb"),
         nargs="*",
-        help="Minstens 1 Illumina Fastq Format file om te verwerken",
+        help="Minstens 1 Illumina Fastq Format file om te verwerken, "
+        "eventueel gecomprimeerd met gzip of bgzip",
     )
+    # -k/--chunks is the old, misleading name of this option
     server_args.add_argument(
+        "-b",
+        "--batch-size",
         "-k",
         "--chunks",
         action="store",
-        dest="chunks",
+        dest="batch_size",
+        type=parse_batch_size,
+        default=5000,
+        help="Aantal reads per batch bij input die de server zelf leest "
+        "(pipes, gzip streams en --ship-data), of 'auto' om de batch "
+        "grootte en de --range-size af te stemmen op de gemeten rekentijd "
+        "en overhead. Default is 5000",
+    )
+    # add argument for the size of the byte ranges clients read themselves
+    server_args.add_argument(
+        "--range-size",
+        action="store",
+        dest="range_size",
+        type=int,
+        default=RANGE_SIZE,
+        help="Aantal bytes per byte range die clients zelf uit gewone "
+        "bestanden lezen, tenzij -b auto is. Default is 8 MB",
+    )
+
+    # add argument to always send the data instead of byte ranges
+    server_args.add_argument(
+        "--ship-data",
+        action="store_true",
+        dest="ship_data",
+        help="Stuur altijd de quality regels naar de clients. Standaard "
+        "krijgen clients van gewone bestanden alleen een byte range en lezen "
+        "ze die zelf; clients die het pad niet kunnen lezen vragen de data "
+        "dan alsnog op bij de server",
+    )
+
+    # add arguments for the fault tolerance of the job leases
+    server_args.add_argument(
+        "--lease-time",
+        action="store",
+        dest="lease_time",
+        type=float,
+        default=30,
+        help="Seconden zonder heartbeat waarna een job opnieuw wordt "
+        "uitgedeeld. Default is 30",
+    )
+    server_args.add_argument(
+        "--max-attempts",
+        action="store",
+        dest="max_attempts",
+        type=int,
+        default=3,
+        help="Aantal pogingen per job voordat de server opgeeft. Default is 3",
+    )
+    # add argument for the size of the job queue
+    server_args.add_argument(
+        "--queue-size",
+        action="store",
+        dest="queue_size",
         type=int,
-        help="Aantal chunks om te gebruiken.",
+        default=64,
+        help="Maximaal aantal onafgemaakte jobs in de queue. De server leest "
+        "pas verder als er plek is. Default is 64",
     )
 
     # client args
@@ -85,6 +173,15 @@ def parse_args():
         type=int,
         help="Aantal cores om te gebruiken.",
     )
+    # add argument for the number of jobs a worker fetches at once
+    client_args.add_argument(
+        "--prefetch",
+        action="store",
+        dest="prefetch",
+        type=int,
+        default=4,
+        help="Aantal jobs dat een worker per keer ophaalt. Default is 4",
+    )
     # add argument for the server address
     arg_parser.add_argument(
         "-t",
@@ -109,33 +206,421 @@ def parse_args():
 
 
 # CLASSES
+class BatchQueue(queue.Queue):
+    """
+    A queue that can also hand out and take in several items in a single
+    call, so one manager round trip moves a whole group of jobs or results.
+    """
+
+    def get_many(self, max_items, timeout=None):
+        """
+        Block until at least one item is available, then return up to
+        max_items items without waiting for more
+        :param max_items: The maximum number of items to return
+        :param timeout: Seconds to wait for the first item
+        :return: A list of items
+        """
+        items = [self.get(timeout=timeout)]
+        while len(items) < max_items:
+            try:
+                items.append(self.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def put_many(self, items):
+        """
+        Put a list of items on the queue
+        :param items: A list of items
+        """
+        for item in items:
+            self.put(item)
+
+
+class JobBoard:
+    """
+    Hands out jobs under a lease and collects their results. A lease ends
+    when the result of its job comes in. Leases that are not renewed by a
+    heartbeat in time, and jobs that raised an error, are handed out again
+    until a job has been tried max_attempts times. Only the first result
+    of a job is passed on, later duplicates are dropped. The board lives
+    in the manager process and is shared by all clients.
+
+    At most capacity unfinished jobs are kept; put_many blocks until
+    there is room, which makes the server read its input only as fast as
+    the clients work through it.
+
+    Clients that can not read the file of a byte range job themselves
+    fetch the records of the range with read_records instead.
+
+    The board also counts the jobs, reads and bytes every worker has
+    done, which status sums per client host while the server runs.
+    """
+
+    def __init__(self, result_q, lease_time=30, max_attempts=3, capacity=64):
+        self.result_q = result_q
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.capacity = capacity
+        self.condition = threading.Condition()
+        self.jobs = {}
+        self.pending = collections.deque()
+        self.leases = {}
+        self.attempts = collections.Counter()
+        self.finished = set()
+        self.closed = False
+        # last contact with every worker that did not leave yet
+        self.workers = {}
+        # the files read_records may read from
+        self.paths = set()
+        self.started = time.monotonic()
+        self.num_queued = 0
+        self.num_failed = 0
+        self.num_reads = 0
+        self.num_bytes = 0
+        # progress per worker, by its host:pid name
+        self.progress = {}
+
+    def _seen(self, worker, now):
+        """
+        Note contact with a worker, the caller holds the lock
+        :return: The statistics of the worker
+        """
+        self.workers[worker] = now
+        if worker not in self.progress:
+            self.progress[worker] = {
+                "jobs": 0,
+                "reads": 0,
+                "bytes": 0,
+                "first_seen": now,
+                "last_seen": now,
+            }
+        progress = self.progress[worker]
+        progress["last_seen"] = now
+        return progress
+
+    def _progress_per_host(self):
+        """
+        Sum the statistics of the workers of every client host, the caller
+        holds the lock. Several clients may run on the same host.
+        :return: A dict of host names to statistics
+        """
+        hosts = {}
+        for worker, progress in self.progress.items():
+            host = worker.rsplit(":", 1)[0]
+            if host not in hosts:
+                hosts[host] = dict(progress, workers=0)
+            else:
+                total = hosts[host]
+                for key in ("jobs", "reads", "bytes"):
+                    total[key] += progress[key]
+                total["first_seen"] = min(
+                    total["first_seen"], progress["first_seen"]
+                )
+                total["last_seen"] = max(
+                    total["last_seen"], progress["last_seen"]
+                )
+            hosts[host]["workers"] += 1
+        return hosts
+
+    def status(self):
+        """
+        Report the progress of the session
+        :return: A dict with job counts, the overall throughput and the
+        throughput and last contact of every client host
+        """
+        now = time.monotonic()
+        with self.condition:
+            elapsed = max(now - self.started, 1e-9)
+            done = len(self.finished) - self.num_failed
+            clients = {}
+            for host, client in self._progress_per_host().items():
+                busy = max(client["last_seen"] - client["first_seen"], 1e-9)
+                clients[host] = {
+                    "workers": client["workers"],
+                    "jobs_done": client["jobs"],
+                    "reads": client["reads"],
+                    "bytes": client["bytes"],
+                    "reads_per_sec": round(client["reads"] / busy, 1),
+                    "bytes_per_sec": round(client["bytes"] / busy, 1),
+                    "last_seen_sec_ago": round(now - client["last_seen"], 1),
+                }
+            return {
+                "elapsed_sec": round(elapsed, 1),
+                "jobs_queued": self.num_queued,
+                "jobs_pending": len(self.jobs) - len(self.leases),
+                "jobs_leased": len(self.leases),
+                "jobs_done": done,
+                "jobs_failed": self.num_failed,
+                "input_closed": self.closed,
+                "reads": self.num_reads,
+                "bytes": self.num_bytes,
+                "reads_per_sec": round(self.num_reads / elapsed, 1),
+                "bytes_per_sec": round(self.num_bytes / elapsed, 1),
+                "clients": clients,
+            }
+
+    def get_lease_time(self):
+        """
+        Return the number of seconds a lease lasts without a heartbeat
+        """
+        return self.lease_time
+
+    def share_paths(self, paths):
+        """
+        Allow clients to read byte ranges of these files with read_records
+        :param paths: A list of absolute file paths
+        """
+        with self.condition:
+            self.paths.update(paths)
+
+    def read_records(self, path, offset, length):
+        """
+        Read the records of a byte range of an input file for a client that
+        can not read the file itself. The blocks of a BGZF file are
+        decompressed here, since the range alone can not be decoded.
+        :param path: The absolute path of a file shared with share_paths
+        :param offset: The start of the range
+        :param length: The length of the range in bytes
+        :return: The uncompressed records of the range as bytes
+        """
+        if path not in self.paths:
+            raise PermissionError(f"{path} is not an input file")
+        with open_range_reader(path) as reader:
+            return b"".join(reader.blocks(offset, length))
+
+    def put_many(self, jobs):
+        """
+        Add jobs to the board, waiting while it is full
+        :param jobs: A list of job dicts, each with a unique "id"
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: len(self.jobs) + len(jobs) <= max(self.capacity, 1)
+                or not self.jobs
+            )
+            for job in jobs:
+                self.jobs[job["id"]] = job
+                self.pending.append(job["id"])
+            self.num_queued += len(jobs)
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Tell waiting and future workers that no more jobs will come
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def lease(self, worker, max_jobs, timeout=None):
+        """
+        Block until jobs are available and lease up to max_jobs of them
+        :param worker: A unique name of the worker process
+        :param max_jobs: The maximum number of jobs to return
+        :param timeout: Seconds to wait for a job
+        :return: A list of jobs, or [POISONPILL] once the board is closed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            self._seen(worker, time.monotonic())
+            while True:
+                self.expire_leases()
+                jobs = self._take(worker, max_jobs)
+                if jobs:
+                    return jobs
+                if self.closed:
+                    return [Server.POISONPILL]
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                self.condition.wait(remaining)
+
+    def _take(self, worker, max_jobs):
+        """
+        Lease up to max_jobs pending jobs, the caller holds the lock
+        """
+        jobs = []
+        expires = time.monotonic() + self.lease_time
+        while self.pending and len(jobs) < max_jobs:
+            job_id = self.pending.popleft()
+            if job_id in self.finished or job_id in self.leases:
+                continue
+            self.attempts[job_id] += 1
+            self.leases[job_id] = (worker, expires)
+            jobs.append(self.jobs[job_id])
+        return jobs
+
+    def heartbeat(self, workers):
+        """
+        Renew the leases of workers that are still alive
+        :param workers: A list of worker names
+        """
+        workers = set(workers)
+        now = time.monotonic()
+        expires = now + self.lease_time
+        with self.condition:
+            for worker in workers:
+                self._seen(worker, now)
+            for job_id, (worker, _) in self.leases.items():
+                if worker in workers:
+                    self.leases[job_id] = (worker, expires)
+
+    def leave(self, worker):
+        """
+        Tell the board a worker has stopped
+        :param worker: The name of the worker
+        """
+        with self.condition:
+            self.workers.pop(worker, None)
+            self.condition.notify_all()
+
+    def num_workers(self):
+        """
+        Count the workers that were heard from within the lease time
+        :return: The number of live workers
+        """
+        now = time.monotonic()
+        with self.condition:
+            return sum(
+                now - seen <= self.lease_time for seen in self.workers.values()
+            )
+
+    def wait_for_workers(self, timeout):
+        """
+        Wait until every worker that was heard from recently has left
+        :param timeout: The maximum number of seconds to wait
+        :return: True if all workers left in time
+        """
+
+        def all_left():
+            now = time.monotonic()
+            return all(
+                now - seen > self.lease_time for seen in self.workers.values()
+            )
+
+        with self.condition:
+            return self.condition.wait_for(all_left, timeout)
+
+    def expire_leases(self):
+        """
+        Hand out the jobs of expired leases again
+        :return: The number of expired leases
+        """
+        now = time.monotonic()
+        with self.condition:
+            expired = [
+                job_id
+                for job_id, (_, expires) in self.leases.items()
+                if expires < now
+            ]
+            for job_id in expired:
+                worker, _ = self.leases.pop(job_id)
+                self._retry(job_id, f"lease of {worker} expired")
+            if expired:
+                self.condition.notify_all()
+            return len(expired)
+
+    def _retry(self, job_id, error):
+        """
+        Queue a job again, or give up on it after max_attempts tries; the
+        caller holds the lock
+        """
+        if self.attempts[job_id] < self.max_attempts:
+            self.pending.append(job_id)
+            return
+        self.finished.add(job_id)
+        self.num_failed += 1
+        del self.jobs[job_id]
+        self.result_q.put({"id": job_id, "error": error})
+
+    def submit(self, worker, results):
+        """
+        Hand in the results of leased jobs
+        :param worker: The name of the worker that ran the jobs
+        :param results: A list of result dicts with the "id" of their job
+        and either a "result" or an "error"
+        """
+        accepted = []
+        with self.condition:
+            progress = self._seen(worker, time.monotonic())
+            for result in results:
+                job_id = result["id"]
+                if job_id in self.finished:
+                    # the job was also run elsewhere after a lease expired
+                    continue
+                owner = self.leases.get(job_id, (None,))[0]
+                if "error" in result:
+                    if owner == worker:
+                        del self.leases[job_id]
+                        self._retry(job_id, result["error"])
+                    continue
+                self.leases.pop(job_id, None)
+                self.finished.add(job_id)
+                num_bytes = job_size(self.jobs.pop(job_id))
+                num_reads = result["result"].num_reads
+                progress["jobs"] += 1
+                progress["reads"] += num_reads
+                progress["bytes"] += num_bytes
+                self.num_reads += num_reads
+                self.num_bytes += num_bytes
+                accepted.append(result)
+            self.condition.notify_all()
+        self.result_q.put_many(accepted)
+
+
 class Server:
     """
     A class to create a server for the client-server model.
     """
 
     POISONPILL = "MEMENTOMORI"
+    # seconds a blocking get on the result queue waits before retrying
+    RESULT_TIMEOUT = 1
+    # number of jobs or results moved per manager round trip
+    GROUP_SIZE = 16
+    # maximum number of seconds to wait for clients to leave at the end
+    SHUTDOWN_GRACE = 5
+    # maximum number of seconds a read batch waits for its group to fill
+    FLUSH_INTERVAL = 0.1
 
-    def __init__(self, host, port, authkey, csvfile=None):
+    # pylint: disable-next=too-many-arguments
+    def __init__(
+        self,
+        host,
+        port,
+        authkey,
+        csvfile=None,
+        lease_time=30,
+        max_attempts=3,
+        queue_size=64,
+    ):
         self.host = host
         self.port = port
         self.authkey = authkey
         self.csvfile = csvfile
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.queue_size = queue_size
 
     def make_server_manager(self):
         """
         Create a manager for the server, listening on the given port.
-        Return a manager object with get_job_q and get_result_q methods.
+        Return a manager object with get_job_board and get_result_q methods.
         """
-        job_q = queue.Queue()
-        result_q = queue.Queue()
+        result_q = BatchQueue()
+        job_board = JobBoard(
+            result_q, self.lease_time, self.max_attempts, self.queue_size
+        )
 
         class QueueManager(BaseManager):
             """
             A class to create a manager for the server.
             """
 
-        QueueManager.register("get_job_q", callable=lambda: job_q)
+        QueueManager.register("get_job_board", callable=lambda: job_board)
         QueueManager.register("get_result_q", callable=lambda: result_q)
 
         manager = QueueManager(
@@ -145,45 +630,164 @@ class Server:
         print(f"Server started at port {self.port}")
         return manager
 
-    def runserver(self, function, data):
+    def runserver(self, inputs):
         """
-        Run the server, sending data to the client.
+        Run the server, sending the jobs of all input files to the clients
+        in one session, and write the results per input file.
+
+        Jobs are put on the board by a separate thread while the input is
+        still being read, so clients start working right away. The board
+        is bounded, so the feeder only reads ahead as far as there is room
+        for. The data of an input may also be a generator that waits for
+        results, like adaptive_batches does while its BatchSizer is
+        probing. Once all jobs are queued the feeder puts their number on
+        the result queue, so the server can block on that queue instead of
+        polling it. If reading the input fails, the feeder puts a marker on
+        the result queue instead and the error is raised here, after the
+        clients are told to stop.
+        :param inputs: A list of (name, function, data, sizer) tuples, where
+        function is the name of the job function in JOB_FUNCTIONS, data an
+        iterable of job arguments and sizer an optional BatchSizer
         """
         manager = self.make_server_manager()
-        shared_job_q = manager.get_job_q()
+        shared_job_board = manager.get_job_board()
         shared_result_q = manager.get_result_q()
+        shared_job_board.share_paths(
+            [
+                os.path.abspath(name)
+                for name, function, _, _ in inputs
+                if function == "calculate_sums_from_range"
+            ]
+        )
 
-        if not data:
-            print("No data to send!")
-            return
+        # the exception that stopped the feeder, if any
+        feed_errors = []
+
+        def feed():
+            count = 0
+            jobs = []
+            flushed = time.monotonic()
+            try:
+                for index, (_, function, data, sizer) in enumerate(inputs):
+                    for number, data_part in enumerate(data):
+                        # the job id tells which input file the job is from
+                        jobs.append(
+                            {
+                                "id": (index, number),
+                                "fn": function,
+                                "arg": data_part,
+                            }
+                        )
+                        count += 1
+                        # send a group once it is full or has waited long
+                        # enough, probe batches wait for their result so go
+                        # at once
+                        if (
+                            len(jobs) == Server.GROUP_SIZE
+                            or time.monotonic() - flushed
+                            > Server.FLUSH_INTERVAL
+                            or (sizer is not None and sizer.probing)
+                        ):
+                            # blocks while the board is full
+                            shared_job_board.put_many(jobs)
+                            jobs = []
+                            flushed = time.monotonic()
+                if jobs:
+                    shared_job_board.put_many(jobs)
+            except Exception as error:  # pylint: disable=broad-except
+                feed_errors.append(error)
+                shared_result_q.put({"feed_error": repr(error)})
+                return
+            shared_result_q.put({"num_jobs": count})
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
         print("Ready to send data to clients!")
-        for data_part in data:
-            shared_job_q.put({"fn": function, "arg": data_part})
-        results = []
-        while True:
+        totals = [PhredAccumulator() for _ in inputs]
+        errors = []
+        num_jobs = None
+        num_results = 0
+        while not feed_errors and (num_jobs is None or num_results < num_jobs):
             try:
-                result = shared_result_q.get_nowait()
-                results.append(result)
-                if len(results) == len(data):
-                    print("Got all results!")
-                    break
+                results = shared_result_q.get_many(
+                    Server.GROUP_SIZE, timeout=Server.RESULT_TIMEOUT
+                )
             except queue.Empty:
+                # nothing came in for a while, look for clients that died
+                shared_job_board.expire_leases()
                 continue
+            for result in results:
+                if "num_jobs" in result:
+                    num_jobs = result["num_jobs"]
+                    continue
+                if "feed_error" in result:
+                    continue
+                num_results += 1
+                index = result["id"][0]
+                sizer = inputs[index][3]
+                if "error" in result:
+                    errors.append(result)
+                    # the feeder waits for the result of a probe batch
+                    if sizer is not None and sizer.probing:
+                        sizer.skip()
+                    continue
+                totals[index].merge(result["result"])
+                if sizer is not None and sizer.probing:
+                    # the batch size should leave work for every worker
+                    # that is connected by now
+                    sizer.num_workers = max(shared_job_board.num_workers(), 1)
+                    sizer.record(result["time"])
+        if not feed_errors:
+            print("Got all results!")
         # Tell the client process no more data will be forthcoming
         print("Time to kill some peons!")
-        shared_job_q.put(Server.POISONPILL)
-        # Sleep a bit before shutting down the server - to give clients time to
-        # realize the job queue is empty and exit in an orderly way.
-        time.sleep(5)
-        means = [r["result"] for r in results]
-        total_means = MeanPhredCalculator.calculate_total_means(means)
+        shared_job_board.close()
+        # give clients time to realize there are no more jobs and exit in
+        # an orderly way, before the manager goes away
+        shared_job_board.wait_for_workers(Server.SHUTDOWN_GRACE)
+        print("Shutting down server")
+        manager.shutdown()
+        if feed_errors:
+            raise feed_errors[0]
+        if errors:
+            raise RuntimeError(
+                f"{len(errors)} of {num_jobs} jobs failed after "
+                f"{self.max_attempts} attempts, first error: "
+                f"{errors[0]['error']}"
+            )
+        if num_results == 0:
+            print("No data to send!")
+            return
+        self.write_results(
+            [name for name, _, _, _ in inputs],
+            [total.means() for total in totals],
+        )
+
+    def write_results(self, names, results):
+        """
+        Write the mean phred scores to the csv file or stdout, keyed by
+        file name if there is more than one input file
+        :param names: The names of the input files
+        :param results: A list with an array of means for every input file
+        """
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
+        if len(results) == 1:
+            data_frame = pd.DataFrame(results[0])
+        else:
+            data_frame = pd.concat(
+                {
+                    name: pd.DataFrame(means)
+                    for name, means in zip(names, results)
+                }
+            )
         # write to output
         if self.csvfile:
-            pd.DataFrame(total_means).to_csv(self.csvfile, header=False)
+            data_frame.to_csv(self.csvfile, header=False)
+            # do not leave the output to the file being finalized at exit
+            self.csvfile.flush()
         else:
-            pd.DataFrame(total_means).to_csv(sys.stdout, header=False)
-        print("Shutting down server")
-        manager.shutdown()
+            data_frame.to_csv(sys.stdout, header=False)
 
 
 class Client:
@@ -192,11 +796,14 @@ class Client:
     """
 
     POISONPILL = "MEMENTOMORI"
+    # seconds a blocking get on the job queue waits before retrying
+    JOB_TIMEOUT = 1
 
-    def make_client_manager(self, ipaddress, port, authkey):
+    @staticmethod
+    def make_client_manager(ipaddress, port, authkey):
         """Create a manager for a client. This manager connects to a server on the
-        given address and exposes the get_job_q and get_result_q methods for
-        accessing the shared queues from the server.
+        given address and exposes the get_job_board method for accessing the
+        shared job board of the server.
         Return a manager object.
         """
 
@@ -205,68 +812,142 @@ class Client:
             A class to create a manager for the client.
             """
 
-        ServerQueueManager.register("get_job_q")
-        ServerQueueManager.register("get_result_q")
+        ServerQueueManager.register("get_job_board")
 
         manager = ServerQueueManager(address=(ipaddress, port), authkey=authkey)
         manager.connect()
-
-        print(f"Client connected to {ipaddress}:{port}")
         return manager
 
-    def runclient(self, num_processes, ipaddress, port, authkey):
+    # pylint: disable-next=too-many-arguments
+    def runclient(self, num_processes, ipaddress, port, authkey, prefetch=1):
         """
         Run the client, connecting to the server and starting the worker
         processes.
         """
-        manager = self.make_client_manager(ipaddress, port, authkey)
-        job_q = manager.get_job_q()
-        result_q = manager.get_result_q()
-        self.run_workers(job_q, result_q, num_processes)
+        manager = Client.make_client_manager(ipaddress, port, authkey)
+        print(f"Client connected to {ipaddress}:{port}")
+        job_board = manager.get_job_board()
+        self.run_workers(job_board, num_processes, prefetch)
 
-    def run_workers(self, job_q, result_q, ncores):
+    @staticmethod
+    def show_status(ipaddress, port, authkey):
+        """
+        Print the progress of a running server as JSON
+        """
+        manager = Client.make_client_manager(ipaddress, port, authkey)
+        print(json.dumps(manager.get_job_board().status(), indent=2))
+
+    @staticmethod
+    def worker_name(pid):
+        """
+        Return the name under which a worker process leases jobs
+        :param pid: The process id of the worker
+        """
+        return f"{socket.gethostname()}:{pid}"
+
+    def run_workers(self, job_board, ncores, prefetch=1):
         """
         Run the worker processes. This function creates a number of
         processes and starts them. Each process runs the peon function,
-        which gets jobs from the job queue and puts results in the result
-        queue.
+        which leases jobs from the job board and hands in their results.
+        While they run, the leases of the workers that are still alive
+        are renewed with regular heartbeats.
         """
         processes = []
         for _ in range(ncores):
             temp_process = mp.Process(
-                target=Client.peon, args=(job_q, result_q)
+                target=Client.peon, args=(job_board, prefetch)
             )
             processes.append(temp_process)
             temp_process.start()
         print(f"Started {len(processes)} workers!")
+        interval = job_board.get_lease_time() / 3
+        alive = processes
+        while alive:
+            try:
+                job_board.heartbeat(
+                    [
+                        self.worker_name(temp_process.pid)
+                        for temp_process in alive
+                    ]
+                )
+            except (ConnectionError, EOFError):
+                # the server shut down after the last worker left
+                break
+            alive[0].join(interval)
+            alive = [p for p in alive if p.is_alive()]
         for temp_process in processes:
             temp_process.join()
 
     @staticmethod
-    def peon(job_q, result_q):
+    def peon(job_board, prefetch=1):
         """
-        A worker process that gets jobs from the job queue and puts
-        results in the result queue.
+        A worker process that leases jobs from the job board and hands in
+        their results. Up to prefetch jobs are leased in one request and
+        their results are handed in together.
         """
         my_name = mp.current_process().name
+        worker = Client.worker_name(os.getpid())
+        readable = {}
         while True:
             try:
-                job = job_q.get_nowait()
-                if job == Client.POISONPILL:
-                    job_q.put(Client.POISONPILL)
-                    print("killed peon", my_name)
-                    return
-                else:
-                    try:
-                        result = job["fn"](job["arg"])
-                        result_q.put({"job": job, "result": result})
-                    except NameError as error:
-                        print("Error in worker process", error)
-                        result_q.put({"job": job, "result": "some error"})
-
+                # blocks in the manager, so a new job arrives right away
+                jobs = job_board.lease(
+                    worker, prefetch, timeout=Client.JOB_TIMEOUT
+                )
             except queue.Empty:
-                print("sleeping", my_name)
-                time.sleep(1)
+                continue
+            if jobs == [Client.POISONPILL]:
+                job_board.leave(worker)
+                print("killed peon", my_name)
+                return
+            results = []
+            for job in jobs:
+                try:
+                    if job["fn"] == "calculate_sums_from_range":
+                        job = Client.localize(job_board, job, readable)
+                    start = time.perf_counter()
+                    result = JOB_FUNCTIONS[job["fn"]](job["arg"])
+                    results.append(
+                        {
+                            "id": job["id"],
+                            "result": result,
+                            "time": time.perf_counter() - start,
+                        }
+                    )
+                except Exception as error:  # pylint: disable=broad-except
+                    print("Error in worker process", error)
+                    results.append({"id": job["id"], "error": repr(error)})
+            job_board.submit(worker, results)
+
+    @staticmethod
+    def localize(job_board, job, readable):
+        """
+        Turn a byte range job into a job that carries the data of the range
+        when this client can not read the file of the range itself, for
+        example because the path only exists on the server
+        :param job_board: The shared job board
+        :param job: A job for calculate_sums_from_range
+        :param readable: A dict caching whether each path is readable here
+        :return: The job itself, or a job for calculate_sums_from_block
+        """
+        path, size, offset, length = job["arg"]
+        if path not in readable:
+            # a file of another size at the same path is not the same file
+            readable[path] = (
+                os.access(path, os.R_OK) and os.path.getsize(path) == size
+            )
+            if not readable[path]:
+                print(
+                    f"Can not read {path}, fetching its data from the server"
+                )
+        if readable[path]:
+            return job
+        return {
+            "id": job["id"],
+            "fn": "calculate_sums_from_block",
+            "arg": job_board.read_records(path, offset, length),
+        }
 
 
 class MeanPhredCalculator:
@@ -280,14 +961,11 @@ class MeanPhredCalculator:
     @staticmethod
     def read_phreds(file):
         """
-        Return the PHRED scores from a FASTQ file as a list of Numpy arrays.
+        Yield the PHRED lines of a FASTQ file one at a time as bytes.
         """
-        phred_scores = []
         for i, line in enumerate(file):
             if i % 4 == 3:
-                phred_scores.append(line.strip())
-
-        return phred_scores
+                yield line.strip()
 
     @staticmethod
     def batch_iterator(iterator, batch_size):
@@ -314,30 +992,75 @@ class MeanPhredCalculator:
             yield batch
 
     @staticmethod
-    def calculate_means_from_batch(batch):
+    def calculate_sums_from_batch(batch):
         """
-        Calculate the means of the phred score from a batch of records
-        :param batch: A batch of records
-        :return: A list of the mean phred scores for each base position in the records
+        Calculate the per-position phred sums and counts of a batch of records
+        :param batch: A batch of quality lines as bytes
+        :return: A PhredAccumulator holding the sums and counts of the batch
         """
-        ascii_dict = {chr(i): i - 33 for i in range(33, 127)}
-        phreds = np.array(
-            [[ascii_dict[ch] for ch in phred_line] for phred_line in batch]
-        )
-        return np.mean(phreds, axis=0)
+        return PhredAccumulator.from_batch(batch)
+
+    @staticmethod
+    def read_ranges(path, range_size, sizer=None):
+        """
+        Yield the byte ranges of a FASTQ file as job arguments, so clients
+        only get told where to read instead of getting the data itself
+        :param path: The path of the FASTQ file, which may be BGZF compressed
+        :param range_size: The size of every range in bytes
+        :param sizer: An optional BatchSizer in bytes that picks the size
+        :return: A generator of (path, file size, offset, length) tuples
+        """
+        path = os.path.abspath(path)
+        with open_range_reader(path) as reader:
+            if sizer is None:
+                ranges = reader.ranges(range_size)
+            else:
+                ranges = adaptive_ranges(reader, sizer)
+            for offset, length in ranges:
+                yield path, reader.size, offset, length
+
+    @staticmethod
+    def calculate_sums_from_range(file_range):
+        """
+        Calculate the per-position phred sums and counts of a byte range
+        that the client reads from its own copy of the file
+        :param file_range: A (path, file size, offset, length) tuple
+        :return: A PhredAccumulator holding the sums and counts of the range
+        """
+        path, _, offset, length = file_range
+        return accumulate_range(path, offset, length)
 
     @staticmethod
-    def calculate_total_means(means_per_batch):
+    def calculate_sums_from_block(block):
         """
-        Calculate the total mean phred score per base position from a list of means per batch
-        :param means_per_batch: A list of means per batch
-        :return: The total mean phred score
+        Calculate the per-position phred sums and counts of complete FASTQ
+        records sent by the server
+        :param block: The bytes of a byte range
+        :return: A PhredAccumulator holding the sums and counts of the block
         """
-        total_means = np.vstack(means_per_batch)
-        return total_means.mean(axis=0)
+        return PhredAccumulator().add_block(block)
 
 
 # FUNCTIONS
+def job_size(job):
+    """
+    Return the number of input bytes a job covers
+    :param job: A job dict
+    :return: The length of its byte range or the size of its batch
+    """
+    if job["fn"] == "calculate_sums_from_range":
+        return job["arg"][3]
+    if job["fn"] == "calculate_sums_from_block":
+        return len(job["arg"])
+    return sum(len(line) for line in job["arg"])
+
+
+# jobs refer to their function by name, so no function is pickled per job
+JOB_FUNCTIONS = {
+    "calculate_sums_from_batch": MeanPhredCalculator.calculate_sums_from_batch,
+    "calculate_sums_from_range": MeanPhredCalculator.calculate_sums_from_range,
+    "calculate_sums_from_block": MeanPhredCalculator.calculate_sums_from_block,
+}
 
 
 # MAIN
@@ -345,6 +1068,7 @@ def main():
     """
     Main function
     """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     args = parse_args()
     authkey = b"secretauthkey"
 
@@ -354,17 +1078,40 @@ def main():
             port=args.port,
             authkey=authkey,
             csvfile=args.csvfile,
+            lease_time=args.lease_time,
+            max_attempts=args.max_attempts,
+            queue_size=args.queue_size,
         )
 
         mpc = MeanPhredCalculator()
+        # one session for all files, read lazily when the feeder gets there
+        inputs = []
         for file in args.fastq_files:
-            print(f"Reading file {file.name}")
-            records = mpc.read_phreds(file)
-            batches = list(mpc.batch_iterator(records, args.chunks))
-            server.runserver(
-                function=MeanPhredCalculator.calculate_means_from_batch,
-                data=batches,
+            sizer = None
+            if not args.ship_data and is_mappable(file):
+                # clients read the ranges themselves
+                if args.batch_size == "auto":
+                    sizer = BatchSizer(
+                        PROBE_BYTES,
+                        total=os.path.getsize(file.name),
+                        unit="bytes",
+                    )
+                ranges = mpc.read_ranges(file.name, args.range_size, sizer)
+                inputs.append(
+                    (file.name, "calculate_sums_from_range", ranges, sizer)
+                )
+                continue
+            # pipes and gzip streams are read line by line
+            records = mpc.read_phreds(open_fastq(file))
+            if args.batch_size == "auto":
+                sizer = BatchSizer(PROBE_READS)
+                batches = adaptive_batches(records, sizer)
+            else:
+                batches = mpc.batch_iterator(records, args.batch_size)
+            inputs.append(
+                (file.name, "calculate_sums_from_batch", batches, sizer)
             )
+        server.runserver(inputs=inputs)
 
     elif args.client:
         client = Client()
@@ -373,6 +1120,12 @@ def main():
             ipaddress=args.host,
             port=args.port,
             authkey=authkey,
+            prefetch=args.prefetch,
+        )
+
+    elif args.status:
+        Client.show_status(
+            ipaddress=args.host, port=args.port, authkey=authkey
         )
 
 
@@ -7,11 +7,24 @@ Calculate the mean phred score for each base position in a fastq file.
 
 # IMPORTS
 import argparse as ap
+import io
+import os
 import sys
-import warnings
 
-import numpy as np
-import pandas as pd
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from phredlib import PhredAccumulator  # noqa: E402
+from phredlib.bgzf import open_fastq  # noqa: E402
+from phredlib.chunks import (  # noqa: E402
+    FRAME_SIZE,
+    ChunkReducer,
+    ChunkResult,
+    cut_frames,
+    read_frames,
+    write_frame,
+)
+from phredlib.reader import FastqStream  # noqa: E402
 
 
 # CLASSES
@@ -37,6 +50,31 @@ class MeanPhredCalculator:
         mode = arg_parser.add_mutually_exclusive_group(required=True)
         mode.add_argument("--chunkmode", action="store_true")
         mode.add_argument("--totalmode", action="store_true")
+        # cut stdin into frames for long-lived workers in workermode
+        mode.add_argument("--framemode", action="store_true")
+        mode.add_argument("--workermode", action="store_true")
+
+        # Add argument for the sequence number of the chunk
+        arg_parser.add_argument(
+            "--chunk-id",
+            action="store",
+            dest="chunk_id",
+            type=int,
+            default=0,
+            help="Volgnummer van de chunk in het bestand, zodat records die "
+            "over twee chunks zijn geknipt weer aan elkaar gezet kunnen "
+            "worden. Geef {#} mee vanuit GNU parallel",
+        )
+
+        # Add argument for the size of the frames
+        arg_parser.add_argument(
+            "--frame-size",
+            action="store",
+            dest="frame_size",
+            type=int,
+            default=FRAME_SIZE,
+            help="Aantal bytes per frame in framemode. Default is 16 MB",
+        )
 
         # Add argument for the output file
         arg_parser.add_argument(
@@ -52,71 +90,38 @@ class MeanPhredCalculator:
         return arg_parser.parse_args()
 
     @staticmethod
-    def read_phreds():
-        """
-        Return the PHRED scores from a FASTQ file as a list of Numpy arrays.
+    def read_blocks(stream):
         """
-        for i, line in enumerate(sys.stdin):
-            if i % 4 == 3:
-                yield line.strip()
-
-    @staticmethod
-    def batch_iterator(iterator, batch_size):
-        """Returns lists of length batch_size.
-
-        This can be used on any iterator, for example to batch up
-        SeqRecord objects from Bio.SeqIO.parse(...), or to batch
-        Alignment objects from Bio.Align.parse(...), or simply
-        lines from a file handle.
-
-        This is a generator function, and it returns lists of the
-        entries from the supplied iterator.  Each list will have
-        batch_size entries, although the final list may be shorter.
-
-        Found at https://biopython.org/wiki/Split_large_file
+        Read the FASTQ records of a chunk in blocks of a fixed size, so the
+        memory a chunk needs does not depend on its size. Iterating the
+        returned FastqStream yields the blocks; afterwards it holds the
+        fragments of records cut off at either end of the chunk.
+        :param stream: A binary file object holding the chunk
         """
-        batch = []
-        for entry in iterator:
-            batch.append(entry)
-            if len(batch) == batch_size:
-                yield batch
-                batch = []
-        if batch:
-            yield batch
+        return FastqStream(stream)
 
     @staticmethod
-    def calculate_means_from_batch(batch):
+    def calculate_sums_from_blocks(blocks):
         """
-        Calculate the means of the phred score from a batch of records
-        :param batch: A batch of records
-        :return: A list of the mean phred scores for each base position in the records
+        Calculate the per-position phred sums and counts of blocks of records
+        :param blocks: An iterable of buffers holding complete FASTQ records
+        :return: A PhredAccumulator holding the sums and counts of the blocks
         """
-        ascii_dict = {chr(i): i - 33 for i in range(33, 127)}
-        max_length = max(len(line) for line in batch)
-        phreds = []
+        total = PhredAccumulator()
+        for block in blocks:
+            total.add_block(block)
+        return total
 
-        for phred_line in batch:
-            phreds_num = np.full((max_length,), np.nan)
-            for i, character in enumerate(phred_line):
-                phreds_num[i] = ascii_dict[character]
-            phreds.append(phreds_num)
-
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            with np.errstate(invalid="ignore"):
-                return np.nanmean(phreds, axis=0)
-
-    @staticmethod
-    def calculate_total_means(means_per_batch):
+    def calculate_chunk(self, chunk_id, stream):
         """
-        Calculate the total mean phred score per base position from a list of means per batch
-        :param means_per_batch: A list of means per batch
-        :return: The total mean phred score
+        Calculate the result of a single chunk
+        :param chunk_id: The sequence number of the chunk in the file
+        :param stream: A binary file object holding the chunk
+        :return: A ChunkResult with the sums, counts and edge fragments
         """
-        total_means = np.vstack(means_per_batch)
-        means = total_means.mean(axis=0)
-        means = means[~np.isnan(means)]
-        return means
+        records = self.read_blocks(stream)
+        batch_sums = self.calculate_sums_from_blocks(records)
+        return ChunkResult.from_stream(chunk_id, records, batch_sums)
 
     def write_to_csv(self, total_means):
         """
@@ -124,6 +129,8 @@ class MeanPhredCalculator:
 
         :param total_means: An array of the total means
         """
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
         data_frame = pd.DataFrame(total_means)
         data_frame.to_csv(self.args.csvfile, header=False)
 
@@ -134,6 +141,8 @@ class MeanPhredCalculator:
 
         :param total_means: An array of the total means
         """
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
         data_frame = pd.DataFrame(total_means)
         data_frame.to_csv(sys.stdout, header=False)
 
@@ -149,25 +158,40 @@ def main():
     mpc = MeanPhredCalculator()
 
     if mpc.args.chunkmode:
-        records = list(mpc.read_phreds())
-        means = mpc.calculate_means_from_batch(records)
-        if len(means) > 1:
-            print(" ".join(str(x) for x in means))
+        # one binary record per chunk with the int64 sums and counts and
+        # the cut off records at its edges, also for an empty chunk; a gzip
+        # compressed chunk is decompressed on the fly
+        mpc.calculate_chunk(
+            mpc.args.chunk_id, open_fastq(sys.stdin.buffer)
+        ).write_to(sys.stdout.buffer)
+
+    elif mpc.args.framemode:
+        # number the frames here, as one worker gets many of them
+        frames = cut_frames(open_fastq(sys.stdin.buffer), mpc.args.frame_size)
+        for chunk_id, payload in enumerate(frames, start=1):
+            write_frame(sys.stdout.buffer, chunk_id, payload)
+
+    elif mpc.args.workermode:
+        # a single process handles every frame it gets, so the interpreter
+        # and its imports start only once per worker
+        for chunk_id, payload in read_frames(sys.stdin.buffer):
+            mpc.calculate_chunk(chunk_id, io.BytesIO(payload)).write_to(
+                sys.stdout.buffer
+            )
 
     elif mpc.args.totalmode:
-        means_per_batch = []
-        for line in sys.stdin:
-            values = np.fromstring(line.strip(), sep=" ")
-            means_per_batch.append(values)
-
-        max_len = max(len(arr) for arr in means_per_batch)
-        padded = [
-            np.pad(arr, (0, max_len - len(arr)), constant_values=np.nan)
-            for arr in means_per_batch
-        ]
-
-        total = mpc.calculate_total_means(padded)
-        pd.DataFrame(total).to_csv(sys.stdout, header=False, index=False)
+        # fold in the record of every chunk as soon as it arrives
+        reducer = ChunkReducer()
+        for result in ChunkResult.iter_from(sys.stdin.buffer):
+            reducer.add(result)
+        total = reducer.finish()
+
+        # pandas is only needed here, chunks and workers start without it
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
+        pd.DataFrame(total.means()).to_csv(
+            sys.stdout, header=False, index=False
+        )
 
 
 if __name__ == "__main__":
@@ -1,10 +1,36 @@
 #!/bin/bash
 
 INPUT="/students/2023-2024/Thema12/dwiersma_BDC/BDC/rnaseq.fastq"
+# chunk: a new python per block that GNU parallel cuts off
+# worker: one long-lived python per job slot that handles many frames,
+# run with MODE=worker to use it
+MODE="${MODE:-chunk}"
 
-parallel --jobs 4 \
-    --sshlogin nuc112,nuc113 \
-    --pipepart \
-    --recstart '@' \
-    --block 1M \
-    python3 /students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment3/assignment3.py --chunkmode :::: "$INPUT" | python3 /students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment3/assignment3.py --totalmode > output.csv
+if [[ "$MODE" == worker ]]; then
+    # the frames are handed out round robin to the same 4 processes per
+    # host, so python, numpy and pandas start once per job slot instead of
+    # once per block; framemode also decompresses gzip input
+    python3 /students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment3/assignment3.py --framemode < "$INPUT" | parallel --jobs 4 \
+        --sshlogin nuc112,nuc113 \
+        --pipe \
+        --round-robin \
+        --recstart $'\x1eFRAME' \
+        --block 16M \
+        python3 /students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment3/assignment3.py --workermode | python3 /students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment3/assignment3.py --totalmode > output.csv
+elif [[ "$INPUT" == *.gz ]]; then
+    # parallel can only cut plain text into chunks, so decompress first;
+    # bgzip decompresses BGZF blocks with several threads
+    bgzip --decompress --stdout --threads 4 "$INPUT" | parallel --jobs 4 \
+        --sshlogin nuc112,nuc113 \
+        --pipe \
+        --recstart '@' \
+        --block 1M \
+        python3 /students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment3/assignment3.py --chunkmode --chunk-id {#} | python3 /students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment3/assignment3.py --totalmode > output.csv
+else
+    parallel --jobs 4 \
+        --sshlogin nuc112,nuc113 \
+        --pipepart \
+        --recstart '@' \
+        --block 1M \
+        python3 /students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment3/assignment3.py --chunkmode --chunk-id {#} :::: "$INPUT" | python3 /students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment3/assignment3.py --totalmode > output.csv
+fi
@@ -6,16 +6,131 @@ Calculate the mean phred score for each base position in a fastq file.
 
 # IMPORTS
 import argparse as ap
+import json
+import os
 import sys
 import time
-import warnings
+from contextlib import closing, contextmanager
 
 import numpy as np
-import pandas as pd
 from mpi4py import MPI
 
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from phredlib import PhredAccumulator  # noqa: E402
+from phredlib.bgzf import open_fastq  # noqa: E402
+from phredlib.reader import (  # noqa: E402
+    add_mapped_block,
+    is_mappable,
+    open_range_reader,
+    page_in,
+)
+
+# reads per batch when a gzip stream is read line by line
+BATCH_SIZE = 5000
+# bytes per task in the dynamic schedule
+RANGE_SIZE = 4 * 1024 * 1024
+# message tags of the dynamic schedule
+TAG_REQUEST = 1
+TAG_TASK = 2
+# the offset of the task that tells a worker to stop
+NO_TASK = -1
+# the phases a rank spends its time in
+PHASES = ["read", "split", "send", "receive", "compute", "reduce", "write"]
+# the runtime of every run; the old timings.csv did not count rank 0 as a
+# worker, so its rows can not be mixed with these
+RUNTIMES_FILE = "runtimes.csv"
+
 
 # CLASSES
+class RankLog:
+    """
+    The time a rank spends in every phase of a run, kept as totals and as
+    a list of events for a trace. Times are taken with MPI.Wtime and
+    counted from a barrier at the start of the run, so the events of all
+    ranks line up on one time axis.
+    """
+
+    def __init__(self, rank):
+        self.rank = rank
+        self.start = MPI.Wtime()
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.events = []
+        self.tasks = 0
+        self.bytes = 0
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the code in a with block as one of the PHASES
+        :param name: The name of the phase
+        """
+        start = MPI.Wtime()
+        try:
+            yield
+        finally:
+            duration = MPI.Wtime() - start
+            self.seconds[name] += duration
+            self.events.append((name, start - self.start, duration))
+
+    @property
+    def busy(self):
+        """
+        The time spent reading and calculating
+        :return: The busy time in seconds
+        """
+        return self.seconds["read"] + self.seconds["compute"]
+
+    def summary(self, run_id, schedule, size):
+        """
+        Summarise the log as one timing record
+        :param run_id: The ID of the run
+        :param schedule: The schedule of the run
+        :param size: The number of ranks
+        :return: A dict with the time of every phase of this rank
+        """
+        return {
+            "run_id": run_id,
+            "schedule": schedule,
+            "workers": size,
+            "rank": self.rank,
+            "runtime": round(MPI.Wtime() - self.start, 6),
+            "busy": round(self.busy, 6),
+            "tasks": self.tasks,
+            "bytes": self.bytes,
+            **{name: round(value, 6) for name, value in self.seconds.items()},
+        }
+
+    def trace_events(self):
+        """
+        Convert the events to the Chrome trace event format, with one
+        process per rank
+        :return: A list of trace events, times in microseconds
+        """
+        events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.rank,
+                "args": {"name": f"rank {self.rank}"},
+            }
+        ]
+        for name, start, duration in self.events:
+            events.append(
+                {
+                    "name": name,
+                    "cat": name,
+                    "ph": "X",
+                    "pid": self.rank,
+                    "tid": 0,
+                    "ts": round(start * 1e6, 1),
+                    "dur": round(duration * 1e6, 1),
+                }
+            )
+        return events
+
+
 class MeanPhredCalculator:
     """
     A class to calculate the mean phred score of a fastq file.
@@ -49,9 +164,59 @@ class MeanPhredCalculator:
         arg_parser.add_argument(
             "fastq_files",
             action="store",
-            type=ap.FileType("r"),
+            type=ap.FileType("rb"),
             nargs="+",
-            help="Minstens 1 Illumina Fastq Format file om te verwerken",
+            help="Minstens 1 Illumina Fastq Format file om te verwerken, "
+            "eventueel gecomprimeerd met gzip of bgzip",
+        )
+
+        # Add argument for the way the file is divided over the ranks
+        arg_parser.add_argument(
+            "--schedule",
+            action="store",
+            dest="schedule",
+            choices=["static", "dynamic"],
+            default="static",
+            help="static: elke rank krijgt een vast deel van het bestand. "
+            "dynamic: rank 0 deelt kleine stukken uit aan ranks die klaar "
+            "zijn. Default is static",
+        )
+        # Add argument for the size of the dynamic tasks
+        arg_parser.add_argument(
+            "--range-size",
+            action="store",
+            dest="range_size",
+            type=int,
+            default=RANGE_SIZE,
+            help="Aantal bytes per stuk bij --schedule dynamic",
+        )
+        # Add argument for the file with the phase times of every rank
+        arg_parser.add_argument(
+            "--timing-file",
+            action="store",
+            dest="timing_file",
+            type=str,
+            default="timings.jsonl",
+            help="JSON lines file waar de tijd per rank en per fase aan "
+            "toegevoegd wordt",
+        )
+        # Add argument for the ID of the run
+        arg_parser.add_argument(
+            "--run-id",
+            action="store",
+            dest="run_id",
+            type=str,
+            help="ID van de run in de timings. Default is de starttijd",
+        )
+        # Add argument for the trace file
+        arg_parser.add_argument(
+            "--trace",
+            action="store",
+            dest="trace",
+            type=str,
+            help="Schrijf de fases van alle ranks naar dit bestand in het "
+            "Chrome trace formaat (te openen met chrome://tracing of "
+            "Perfetto)",
         )
 
         return arg_parser.parse_args()
@@ -59,14 +224,11 @@ class MeanPhredCalculator:
     @staticmethod
     def read_phreds(file):
         """
-        Return the PHRED scores from a FASTQ file as a list of Numpy arrays.
+        Yield the PHRED lines of a FASTQ file one at a time as bytes.
         """
-        phred_scores = []
         for i, line in enumerate(file):
             if i % 4 == 3:
-                phred_scores.append(line.strip())
-
-        return phred_scores
+                yield line.strip()
 
     @staticmethod
     def batch_iterator(iterator, batch_size):
@@ -93,38 +255,238 @@ class MeanPhredCalculator:
             yield batch
 
     @staticmethod
-    def calculate_means_from_batch(batch):
+    def calculate_sums_from_batch(batch):
         """
-        Calculate the means of the phred score from a batch of records
-        :param batch: A batch of records
-        :return: A list of the mean phred scores for each base position in the records
+        Calculate the per-position phred sums and counts of a batch of records
+        :param batch: A batch of quality lines as bytes
+        :return: A PhredAccumulator holding the sums and counts of the batch
         """
-        ascii_dict = {chr(i): i - 33 for i in range(33, 127)}
-        max_length = max(len(line) for line in batch)
-        phreds = []
-
-        for phred_line in batch:
-            phreds_num = np.full((max_length,), np.nan)
-            for i, character in enumerate(phred_line):
-                phreds_num[i] = ascii_dict[character]
-            phreds.append(phreds_num)
+        return PhredAccumulator.from_batch(batch)
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            with np.errstate(invalid="ignore"):
-                return np.nanmean(phreds, axis=0)
+    @staticmethod
+    def calculate_sums_from_range(reader, offset, length, log):
+        """
+        Calculate the per-position phred sums and counts of a byte range
+        :param reader: An open FastqRangeReader of the input file
+        :param offset: The start of the range, at a record start
+        :param length: The length of the range in bytes
+        :param log: The RankLog of this rank
+        :return: A PhredAccumulator holding the sums and counts of the range
+        """
+        total = PhredAccumulator()
+        with closing(reader.blocks(offset, length)) as blocks:
+            while True:
+                with log.phase("read"):
+                    block = next(blocks, None)
+                    if block is not None:
+                        # a mapped file is only read when its pages are
+                        # touched, which should not count as compute
+                        page_in(block)
+                if block is None:
+                    break
+                with block, log.phase("compute"):
+                    add_mapped_block(total, block)
+        log.tasks += 1
+        log.bytes += length
+        return total
+
+    def calculate_sums_from_stream(self, file, log):
+        """
+        Calculate the per-position phred sums and counts of a file that
+        can only be read from the start, like a plain gzip file
+        :param file: An open binary file object
+        :param log: The RankLog of this rank
+        :return: A PhredAccumulator holding the sums and counts of the file
+        """
+        total = PhredAccumulator()
+        records = self.read_phreds(open_fastq(file))
+        batches = self.batch_iterator(records, BATCH_SIZE)
+        while True:
+            with log.phase("read"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            with log.phase("compute"):
+                total.add_batch(batch)
+        log.tasks += 1
+        return total
+
+    def calculate_sums(self, comm, log):
+        """
+        Calculate the per-position phred sums and counts of the part of the
+        input file that this rank works on, with the chosen schedule
+        :param comm: The MPI communicator
+        :param log: The RankLog of this rank
+        :return: A PhredAccumulator holding the sums and counts of the part
+        """
+        rank = comm.Get_rank()
+        file = self.args.fastq_files[0]
+        if not is_mappable(file):
+            # a plain gzip stream can not be split, rank 0 reads it all
+            if rank == 0:
+                return self.calculate_sums_from_stream(file, log)
+            return PhredAccumulator()
+        reader = open_range_reader(file.name)
+        with log.phase("read"):
+            reader.open()
+        try:
+            if self.args.schedule == "static":
+                return self.calculate_sums_for_rank(
+                    reader, rank, comm.Get_size(), log
+                )
+            if rank == 0:
+                return self.hand_out_ranges(comm, reader, log)
+            return self.request_ranges(comm, reader, log)
+        finally:
+            reader.close()
+
+    def calculate_sums_for_rank(self, reader, rank, size, log):
+        """
+        Calculate the per-position phred sums and counts of the part of the
+        input file that belongs to a rank. Every rank splits the file the
+        same way and reads its own range, so no data goes through rank 0.
+        :param reader: An open FastqRangeReader of the input file
+        :param rank: The rank of this process
+        :param size: The number of ranks
+        :param log: The RankLog of this rank
+        :return: A PhredAccumulator holding the sums and counts of the part
+        """
+        with log.phase("split"):
+            ranges = reader.split(size)
+        if rank >= len(ranges):
+            # more ranks than there are parts in a small file
+            return PhredAccumulator()
+        offset, length = ranges[rank]
+        return self.calculate_sums_from_range(reader, offset, length, log)
+
+    def hand_out_ranges(self, comm, reader, log):
+        """
+        Answer the requests of the other ranks with the next range of the
+        file, and work on a range itself whenever no request is waiting.
+        Every rank gets NO_TASK once the file is handed out.
+        :param comm: The MPI communicator
+        :param reader: An open FastqRangeReader of the input file
+        :param log: The RankLog of rank 0
+        :return: A PhredAccumulator of the ranges rank 0 worked on
+        """
+        total = PhredAccumulator()
+        tasks = reader.ranges(self.args.range_size)
+        workers = comm.Get_size() - 1
+
+        def next_task():
+            with log.phase("split"):
+                return next(tasks, None)
+
+        task = next_task()
+        if not workers:
+            while task is not None:
+                total.merge(self.calculate_sums_from_range(reader, *task, log))
+                task = next_task()
+            return total
+
+        request = np.empty(1, dtype=np.int64)
+        receive = comm.Irecv(request, source=MPI.ANY_SOURCE, tag=TAG_REQUEST)
+        sends = []
+        while workers:
+            if task is None:
+                with log.phase("receive"):
+                    receive.Wait()
+            elif not receive.Test():
+                total.merge(self.calculate_sums_from_range(reader, *task, log))
+                task = next_task()
+                continue
+            if task is None:
+                message = np.array([NO_TASK, 0], dtype=np.int64)
+                workers -= 1
+            else:
+                message = np.array(task, dtype=np.int64)
+                task = next_task()
+            with log.phase("send"):
+                sends.append(
+                    comm.Isend(message, dest=int(request[0]), tag=TAG_TASK)
+                )
+            if workers:
+                request = np.empty(1, dtype=np.int64)
+                receive = comm.Irecv(
+                    request, source=MPI.ANY_SOURCE, tag=TAG_REQUEST
+                )
+        with log.phase("send"):
+            MPI.Request.Waitall(sends)
+        return total
+
+    def request_ranges(self, comm, reader, log):
+        """
+        Ask rank 0 for ranges and work on them until it sends NO_TASK
+        :param comm: The MPI communicator
+        :param reader: An open FastqRangeReader of the input file
+        :param log: The RankLog of this rank
+        :return: A PhredAccumulator of the ranges this rank worked on
+        """
+        total = PhredAccumulator()
+        request = np.array([comm.Get_rank()], dtype=np.int64)
+
+        def ask():
+            with log.phase("send"):
+                task = np.empty(2, dtype=np.int64)
+                messages = [
+                    comm.Isend(request, dest=0, tag=TAG_REQUEST),
+                    comm.Irecv(task, source=0, tag=TAG_TASK),
+                ]
+            return task, messages
+
+        task, messages = ask()
+        while True:
+            with log.phase("receive"):
+                MPI.Request.Waitall(messages)
+            offset, length = int(task[0]), int(task[1])
+            if offset == NO_TASK:
+                return total
+            # ask for the next range before working on this one, so the
+            # answer is waiting when it is done
+            task, messages = ask()
+            total.merge(
+                self.calculate_sums_from_range(reader, offset, length, log)
+            )
 
     @staticmethod
-    def calculate_total_means(means_per_batch):
+    def reduce_sums(comm, sums, root=0):
         """
-        Calculate the total mean phred score per base position from a list of means per batch
-        :param means_per_batch: A list of means per batch
-        :return: The total mean phred score
+        Add up the sums and counts of all ranks with a buffer based Reduce
+        on int64 arrays, padded to the longest read of any rank
+        :param comm: The MPI communicator
+        :param sums: The PhredAccumulator of this rank
+        :param root: The rank that receives the total
+        :return: The total PhredAccumulator on root, None on other ranks
         """
-        total_means = np.vstack(means_per_batch)
-        means = total_means.mean(axis=0)
-        means = means[~np.isnan(means)]
-        return means
+        length = comm.allreduce(len(sums), op=MPI.MAX)
+        send = np.zeros((2, length), dtype=np.int64)
+        send[0, : len(sums)] = sums.sums
+        send[1, : len(sums)] = sums.counts
+        receive = np.empty_like(send) if comm.Get_rank() == root else None
+        comm.Reduce(send, receive, op=MPI.SUM, root=root)
+        if receive is None:
+            return None
+        return PhredAccumulator(receive[0], receive[1])
+
+    def write_timings(self, records, events):
+        """
+        Append the timing records of all ranks to the timing file, and
+        write the trace if one was asked for
+
+        :param records: A list of RankLog summaries, one per rank
+        :param events: A list of trace event lists, one per rank
+        """
+        with open(self.args.timing_file, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        if self.args.trace:
+            trace = {
+                "traceEvents": [event for rank in events for event in rank],
+                "displayTimeUnit": "ms",
+                "otherData": records[0],
+            }
+            with open(self.args.trace, "w", encoding="utf-8") as f:
+                json.dump(trace, f)
 
     def write_to_csv(self, total_means):
         """
@@ -132,6 +494,8 @@ class MeanPhredCalculator:
 
         :param total_means: An array of the total means
         """
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
         data_frame = pd.DataFrame(total_means)
         with open(self.args.csvfile, "w", encoding="utf-8") as f:
             data_frame.to_csv(f, header=False)
@@ -143,6 +507,8 @@ class MeanPhredCalculator:
 
         :param total_means: An array of the total means
         """
+        import pandas as pd  # pylint: disable=import-outside-toplevel
+
         data_frame = pd.DataFrame(total_means)
         data_frame.to_csv(sys.stdout, header=False)
 
@@ -161,39 +527,45 @@ def main():
 
     mpc = MeanPhredCalculator()
 
+    # the run ID of rank 0, so all ranks agree on it
+    run_id = comm.bcast(
+        mpc.args.run_id or time.strftime("%Y%m%d-%H%M%S"), root=0
+    )
+    comm.Barrier()
+    log = RankLog(rank)
+
+    # every rank, rank 0 included, works on parts of the file
+    range_sums = mpc.calculate_sums(comm, log)
+    with log.phase("reduce"):
+        total = mpc.reduce_sums(comm, range_sums)
+
+    if rank == 0:
+        with log.phase("write"):
+            total_means = total.means()
+
+            print("writing to csv")
+            if mpc.args.csvfile:
+                mpc.write_to_csv(total_means)
+            else:
+                mpc.write_to_stdout(total_means)
+                sys.stdout.flush()
+
+    record = log.summary(run_id, mpc.args.schedule, size)
+    records = comm.gather(record, root=0)
+    events = comm.gather(log.trace_events() if mpc.args.trace else [], root=0)
+
     if rank == 0:
-        start_time = time.time()
-        # controller
-        records = mpc.read_phreds(mpc.args.fastq_files[0])
-        chunks = np.array_split(records, size - 1)
-        for i, chunk in enumerate(chunks):
-            comm.send(chunk.tolist(), dest=i + 1)
-
-        results = []
-        for i in range(1, size):
-            result = comm.recv(source=i)
-            results.append(result)
-
-        total_means = mpc.calculate_total_means(results)
-
-        print("writing to csv")
-        if mpc.args.csvfile:
-            mpc.write_to_csv(total_means)
-        else:
-            mpc.write_to_stdout(total_means)
-            sys.stdout.flush()
-
-        end_time = time.time()
-        runtime = end_time - start_time
-        num_workers = size - 1
-        with open("timings.csv", "a") as f:
-            f.write(f"{num_workers},{runtime:.4f}\n")
-
-    else:
-        # worker
-        chunk = comm.recv(source=0)
-        mean = mpc.calculate_means_from_batch(chunk)
-        comm.send(mean, dest=0)
+        # every rank works, rank 0 included
+        num_workers = size
+        new_file = not os.path.exists(RUNTIMES_FILE)
+        with open(RUNTIMES_FILE, "a") as f:
+            if new_file:
+                f.write("workers,runtime,schedule,run_id\n")
+            f.write(
+                f"{num_workers},{record['runtime']:.4f},"
+                f"{mpc.args.schedule},{run_id}\n"
+            )
+        mpc.write_timings(records, events)
 
 
 if __name__ == "__main__":
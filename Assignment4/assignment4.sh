@@ -10,15 +10,23 @@
 #SBATCH --mem=64G
 
 
-FASTQ_PATH=/students/2023-2024/Thema12/dwiersma_BDC/BDC/rnaseq.fastq
-SCRIPT_PATH=/students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment4/assignment4.py
+FASTQ_PATH="${FASTQ_PATH:-/students/2023-2024/Thema12/dwiersma_BDC/BDC/rnaseq.fastq}"
+SCRIPT_PATH="${SCRIPT_PATH:-/students/2023-2024/Thema12/dwiersma_BDC/BDC/Assignment4/assignment4.py}"
+# for a local comparison of all engines see benchmarks/bench_scaling.py
+SCHEDULES="${SCHEDULES:-static dynamic}"
+WORKERS="${WORKERS:-1 2 3 4}"
+REPEATS="${REPEATS:-3}"
 
-for workers in {1..4}; do
-  for rep in {1..3}; do
-    echo "Running with $workers workers, repetition $rep"
-    mpirun -np $((workers+1)) python3 "$SCRIPT_PATH" \
-      -o "results_w${workers}_r${rep}.csv" \
-      "$FASTQ_PATH"
-      # --run-id "$rep" \
+for schedule in $SCHEDULES; do
+  for workers in $WORKERS; do
+    for rep in $(seq "$REPEATS"); do
+      echo "Running $schedule with $workers workers, repetition $rep"
+      mpirun -np "$workers" python3 "$SCRIPT_PATH" \
+        --schedule "$schedule" \
+        --run-id "${schedule}_w${workers}_r${rep}" \
+        --trace "trace_${schedule}_w${workers}_r${rep}.json" \
+        -o "results_${schedule}_w${workers}_r${rep}.csv" \
+        "$FASTQ_PATH"
+    done
   done
 done
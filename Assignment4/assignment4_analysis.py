@@ -6,10 +6,19 @@ Analyseer de variatie in PHRED scores over meerdere runs.
 
 # IMPORTS
 import os
+import re
 
 import numpy as np
 import pandas as pd
 
+PHASES = ["read", "split", "send", "receive", "compute", "reduce", "write"]
+# below this parallel efficiency adding workers stops paying off
+EFFICIENCY_LIMIT = 0.75
+# results_w2_r1.csv or, with a schedule, results_dynamic_w2_r1.csv
+RESULTS_PATTERN = re.compile(
+    r"results_(?:(?P<schedule>[a-z]+)_)?w(?P<workers>\d+)_r(?P<rep>\d+)\.csv"
+)
+
 
 # CLASSES
 class Analyser:
@@ -22,19 +31,23 @@ class Analyser:
         self.results = {}
 
     def load_data(self):
-        for workers in range(1, 5):
-            self.results[workers] = []
-            for rep in range(1, 4):
-                filename = f"results_w{workers}_r{rep}.csv"
-                if os.path.exists(filename):
-                    arr = (
-                        pd.read_csv(filename, header=None)
-                        .squeeze("columns")
-                        .to_numpy()
-                    )
-                    self.results[workers].append(arr)
-                else:
-                    print(f"{filename} niet gevonden.")
+        found = []
+        for filename in os.listdir("."):
+            match = RESULTS_PATTERN.fullmatch(filename)
+            if match:
+                key = (
+                    match["schedule"] or "static",
+                    int(match["workers"]),
+                    int(match["rep"]),
+                )
+                found.append((key, filename))
+        if not found:
+            print("Geen results_*.csv files gevonden.")
+
+        for (schedule, workers, _), filename in sorted(found):
+            # the means are in the last column, after the position
+            arr = pd.read_csv(filename, header=None).iloc[:, -1].to_numpy()
+            self.results.setdefault(f"{schedule} {workers}", []).append(arr)
 
     def analyse(self):
         print(
@@ -83,19 +96,119 @@ class Analyser:
             )
 
     def analyse_times(self):
-        df = pd.read_csv("timings.csv", names=["workers", "runtime"])
+        runtimes = self.load_runtimes()
+        if runtimes is not None:
+            self.analyse_runtimes(runtimes)
+
+        phases = self.load_timings()
+        if phases is not None:
+            self.analyse_scaling(phases)
+
+    @staticmethod
+    def load_runtimes():
+        if os.path.exists("timings.csv"):
+            # there rank 0 only handed out the work, and the workers column
+            # did not count it
+            print(
+                "timings.csv wordt overgeslagen, daarin telt rank 0 niet mee "
+                "als worker."
+            )
+        if not os.path.exists("runtimes.csv"):
+            print("runtimes.csv niet gevonden.")
+            return None
+        return pd.read_csv("runtimes.csv")
+
+    @staticmethod
+    def analyse_runtimes(df):
         print("Times:")
 
-        for workers in sorted(df["workers"].unique()):
-            runtimes = df[df["workers"] == workers]["runtime"]
+        for (schedule, workers), runtimes in df.groupby(
+            ["schedule", "workers"]
+        )["runtime"]:
             avg = runtimes.mean()
             std = runtimes.std()
             print(
-                f"{workers} workers: gemiddelde tijd {avg:.2f} sec, stddev {std:.2f} sec"
+                f"{schedule} {workers} workers: gemiddelde tijd {avg:.2f} "
+                f"sec, stddev {std:.2f} sec"
+            )
+
+        besttime = (
+            df.groupby(["schedule", "workers"])["runtime"].mean().idxmin()
+        )
+        print(
+            f"Snelste gemiddelde tijd was bij {besttime[1]} workers "
+            f"({besttime[0]})"
+        )
+
+    @staticmethod
+    def load_timings():
+        if not os.path.exists("timings.jsonl"):
+            print("timings.jsonl niet gevonden.")
+            return None
+        return pd.read_json("timings.jsonl", lines=True)
+
+    @staticmethod
+    def analyse_scaling(df):
+        print("Schaalbaarheid per fase (seconden opgeteld over alle ranks):")
+
+        for schedule, runs in df.groupby("schedule"):
+            # per run the slowest rank sets the wall time
+            per_run = runs.groupby(["workers", "run_id"]).agg(
+                wall=("runtime", "max"),
+                **{phase: (phase, "sum") for phase in PHASES},
+            )
+            per_workers = per_run.groupby("workers").mean()
+            base_workers = per_workers.index[0]
+            base = per_workers.iloc[0]
+
+            print(f"{schedule}:")
+            print(
+                f"  {'workers':>7} {'tijd':>7} {'speedup':>7} {'eff':>5}  "
+                + " ".join(f"{phase:>7}" for phase in PHASES)
+            )
+            breakdown = None
+            for workers, row in per_workers.iterrows():
+                speedup = base["wall"] / row["wall"]
+                efficiency = speedup * base_workers / workers
+                print(
+                    f"  {workers:>7} {row['wall']:>7.2f} {speedup:>7.2f} "
+                    f"{efficiency:>5.2f}  "
+                    + " ".join(f"{row[phase]:>7.2f}" for phase in PHASES)
+                )
+                if breakdown is None and efficiency < EFFICIENCY_LIMIT:
+                    breakdown = workers
+
+            if breakdown is None:
+                print(
+                    f"  De efficientie blijft boven {EFFICIENCY_LIMIT:.0%} "
+                    "voor alle aantallen workers"
+                )
+                continue
+            # with perfect scaling the summed time of a phase stays the same
+            extra = per_workers.loc[breakdown, PHASES] - base[PHASES]
+            print(
+                f"  Bij {breakdown} workers zakt de efficientie onder "
+                f"{EFFICIENCY_LIMIT:.0%}; de meeste extra tijd zit in de fase "
+                f"{extra.idxmax()} (+{extra.max():.2f} sec)"
             )
 
-        besttime = df.groupby("workers")["runtime"].mean().idxmin()
-        print(f"Snelste gemiddelde tijd was bij {besttime} workers")
+    def analyse_busy(self):
+        df = self.load_timings()
+        if df is None:
+            return
+        print("Rekentijd per rank:")
+
+        for (schedule, workers), runs in df.groupby(["schedule", "workers"]):
+            per_rank = runs.groupby("rank")[["busy", "tasks", "bytes"]].mean()
+            print(f"{schedule} {workers} workers:")
+            for rank, row in per_rank.iterrows():
+                print(
+                    f"  rank {rank}: {row['busy']:.2f} sec bezig, "
+                    f"{row['tasks']:.0f} taken, {row['bytes'] / 1e6:.1f} MB"
+                )
+            # the slowest rank sets the runtime, compared to an even division
+            imbalance = per_rank["busy"].max() / per_rank["busy"].mean()
+            print(f"  Onbalans (max / gemiddelde rekentijd): {imbalance:.2f}")
 
 
 # MAIN
@@ -104,6 +217,7 @@ def main():
     analyser.load_data()
     analyser.analyse()
     analyser.analyse_times()
+    analyser.analyse_busy()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the PHRED decoding of a batch of quality lines: the original
+per-character dict loop against the vectorized byte-level engine.
+"""
+
+# IMPORTS
+import argparse as ap
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from phredlib import engine  # noqa: E402
+
+
+# FUNCTIONS
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: An argparse object containing the arguments
+    """
+    arg_parser = ap.ArgumentParser(
+        description="Benchmark de PHRED decoding per batch"
+    )
+    arg_parser.add_argument(
+        "-b",
+        "--batch-size",
+        dest="batch_size",
+        type=int,
+        default=5000,
+        help="Aantal reads per batch",
+    )
+    arg_parser.add_argument(
+        "-l",
+        "--read-length",
+        dest="read_length",
+        type=int,
+        default=150,
+        help="Lengte van iedere read",
+    )
+    arg_parser.add_argument(
+        "-r",
+        "--repeats",
+        dest="repeats",
+        type=int,
+        default=5,
+        help="Aantal herhalingen per methode",
+    )
+    return arg_parser.parse_args()
+
+
+def legacy_means_from_batch(batch):
+    """
+    The original dict based implementation, kept as the reference
+    :param batch: A batch of quality lines as str
+    :return: The mean phred score for each base position
+    """
+    ascii_dict = {chr(i): i - 33 for i in range(33, 127)}
+    max_length = max(len(line) for line in batch)
+    phreds = []
+
+    for phred_line in batch:
+        phreds_num = np.full((max_length,), np.nan)
+        for i, character in enumerate(phred_line):
+            phreds_num[i] = ascii_dict[character]
+        phreds.append(phreds_num)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        with np.errstate(invalid="ignore"):
+            return np.nanmean(phreds, axis=0)
+
+
+def engine_means_from_batch(batch):
+    """
+    The vectorized implementation used by the assignment scripts
+    :param batch: A batch of quality lines as bytes
+    :return: The mean phred score for each base position
+    """
+    sums, counts = engine.quality_sums(batch)
+    return engine.mean_from_sums(sums, counts)
+
+
+def make_batch(batch_size, read_length, seed=42):
+    """
+    Create a batch of random quality lines
+    :param batch_size: Number of reads in the batch
+    :param read_length: Length of every read
+    :param seed: Seed for the random generator
+    :return: A list of quality lines as bytes
+    """
+    rng = np.random.default_rng(seed)
+    scores = rng.integers(
+        33, 75, size=(batch_size, read_length), dtype=np.uint8
+    )
+    return [row.tobytes() for row in scores]
+
+
+def reads_per_second(function, batch, repeats):
+    """
+    Time a decoding function on a batch
+    :param function: The function to time
+    :param batch: The batch to decode
+    :param repeats: Number of times to run the function
+    :return: The best throughput in reads per second
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(batch)
+        best = min(best, time.perf_counter() - start)
+    return len(batch) / best
+
+
+# MAIN
+def main():
+    """
+    Main function
+    """
+    args = parse_args()
+    batch = make_batch(args.batch_size, args.read_length)
+    text_batch = [line.decode("ascii") for line in batch]
+
+    if not np.allclose(
+        legacy_means_from_batch(text_batch), engine_means_from_batch(batch)
+    ):
+        sys.exit("The engine and the legacy implementation disagree!")
+
+    legacy = reads_per_second(
+        legacy_means_from_batch, text_batch, args.repeats
+    )
+    vectorized = reads_per_second(engine_means_from_batch, batch, args.repeats)
+    print(f"batch size: {args.batch_size}, read length: {args.read_length}")
+    print(f"legacy dict loop: {legacy:,.0f} reads/sec")
+    print(f"vectorized engine: {vectorized:,.0f} reads/sec")
+    print(f"speedup: {vectorized / legacy:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
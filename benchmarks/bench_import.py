@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the start-up of the assignment scripts with python -X importtime.
+
+The chunk and worker paths of assignment3 run once per block or per job
+slot, so they should not import pandas, which is only needed to write the
+final CSV. The script exits with an error if one of them does.
+"""
+
+# IMPORTS
+import argparse as ap
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+ASSIGNMENT3 = os.path.join(ROOT, "Assignment3", "assignment3.py")
+
+# (name, arguments, whether the path must stay free of pandas)
+COMMANDS = [
+    ("assignment3 --chunkmode", [ASSIGNMENT3, "--chunkmode"], True),
+    ("assignment3 --workermode", [ASSIGNMENT3, "--workermode"], True),
+    ("assignment3 --framemode", [ASSIGNMENT3, "--framemode"], True),
+    ("assignment3 --totalmode", [ASSIGNMENT3, "--totalmode"], False),
+    (
+        "assignment1 --help",
+        [os.path.join(ROOT, "Assignment1", "assignment1.py"), "--help"],
+        True,
+    ),
+    (
+        "assignment2 --help",
+        [os.path.join(ROOT, "Assignment2", "assignment2.py"), "--help"],
+        True,
+    ),
+]
+HEAVY_MODULES = ["numpy", "pandas"]
+
+
+# FUNCTIONS
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: An argparse object containing the arguments
+    """
+    arg_parser = ap.ArgumentParser(
+        description="Benchmark de opstarttijd van de scripts"
+    )
+    arg_parser.add_argument(
+        "-r",
+        "--repeats",
+        dest="repeats",
+        type=int,
+        default=5,
+        help="Aantal herhalingen per commando",
+    )
+    return arg_parser.parse_args()
+
+
+def parse_importtime(stderr):
+    """
+    Read the output of python -X importtime
+    :param stderr: The standard error of the run
+    :return: A tuple of the total import time in microseconds and the set
+    of imported top level packages
+    """
+    total = 0
+    packages = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            # the header line
+            continue
+        packages.add(name.strip().split(".")[0])
+        # nested imports are part of the cumulative time of their parent
+        if not name.startswith("  "):
+            total += int(cumulative)
+    return total, packages
+
+
+def run(arguments):
+    """
+    Run a script once with empty input
+    :param arguments: The script and its arguments
+    :return: A tuple of the wall time in seconds, the import time in
+    microseconds and the set of imported packages
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + arguments,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    return (time.perf_counter() - start,) + parse_importtime(result.stderr)
+
+
+# MAIN
+def main():
+    """
+    Main function
+    """
+    args = parse_args()
+    failures = []
+    print(f"{'command':<28}{'wall ms':>9}{'import ms':>11}  heavy imports")
+    for name, arguments, light in COMMANDS:
+        runs = [run(arguments) for _ in range(args.repeats)]
+        wall, import_time, packages = min(runs, key=lambda item: item[0])
+        heavy = [package for package in HEAVY_MODULES if package in packages]
+        print(
+            f"{name:<28}{wall * 1e3:>9.0f}"
+            f"{import_time / 1e3:>11.0f}  {', '.join(heavy) or '-'}"
+        )
+        if light and "pandas" in packages:
+            failures.append(name)
+    if failures:
+        sys.exit(f"pandas is imported by: {', '.join(failures)}")
+
+
+if __name__ == "__main__":
+    main()
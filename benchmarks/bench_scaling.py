@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the engines of the assignments on one machine over a set of
+synthetic FASTQ sizes and worker counts.
+
+Every engine runs as it would from the command line, so start-up,
+reading and writing are part of the measured time. The median wall time
+of the repeats gives the throughput, and the speedup and efficiency
+against the serial baseline of the same size. Peak RSS is that of the
+largest process of a run, as reported by getrusage. Without the serial
+engine the first measurement of a size is the baseline. Every run is
+checked against the means calculated in this process. All rows go into one CSV
+table together with the commit, so a change can be compared against the
+same baseline later.
+"""
+
+# IMPORTS
+import argparse as ap
+import csv
+import os
+import shlex
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from phredlib.reader import accumulate_range  # noqa: E402
+from phredlib.synthetic import (  # noqa: E402
+    DISTRIBUTIONS,
+    PROFILES,
+    write_fastq,
+)
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SCRIPTS = {
+    number: os.path.join(ROOT, f"Assignment{number}", f"assignment{number}.py")
+    for number in range(1, 5)
+}
+FIELDS = [
+    "commit",
+    "engine",
+    "size_mb",
+    "reads",
+    "workers",
+    "repeats",
+    "wall_sec",
+    "mb_per_sec",
+    "reads_per_sec",
+    "peak_rss_mb",
+    "speedup",
+    "efficiency",
+    "correct",
+]
+# Linux keeps the peak RSS of a process over an exec, so a child forked
+# from this process would report at least its size. The commands are
+# started from this small wrapper instead, which writes the peak RSS of
+# its children in kilobytes to the file in its second argument.
+RSS_WRAPPER = """
+import resource, subprocess, sys
+code = subprocess.call(sys.argv[1], shell=True)
+with open(sys.argv[2], "w") as file:
+    file.write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+sys.exit(code)
+"""
+
+
+# FUNCTIONS
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: An argparse object containing the arguments
+    """
+    arg_parser = ap.ArgumentParser(
+        description="Benchmark de schaalbaarheid van de engines"
+    )
+    arg_parser.add_argument(
+        "-e",
+        "--engines",
+        dest="engines",
+        nargs="+",
+        choices=list(ENGINES),
+        default=list(ENGINES),
+        help="Engines om te meten. Engines waarvan het programma ontbreekt "
+        "worden overgeslagen. Default is alle engines",
+    )
+    arg_parser.add_argument(
+        "-s",
+        "--sizes",
+        dest="sizes",
+        nargs="+",
+        type=int,
+        default=[64],
+        help="Groottes van de synthetische FASTQ files in MB",
+    )
+    arg_parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        nargs="+",
+        type=int,
+        default=[1, 2, 4],
+        help="Aantallen workers om te meten",
+    )
+    arg_parser.add_argument(
+        "-r",
+        "--repeats",
+        dest="repeats",
+        type=int,
+        default=3,
+        help="Aantal herhalingen per meting",
+    )
+    arg_parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        default="bench_scaling.csv",
+        help="CSV file waar de resultaten aan toegevoegd worden",
+    )
+    arg_parser.add_argument(
+        "--data-dir",
+        dest="data_dir",
+        default=os.path.join(tempfile.gettempdir(), "phred_bench"),
+        help="Map voor de synthetische FASTQ files, die hergebruikt worden",
+    )
+    arg_parser.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=42,
+        help="Seed voor de synthetische data",
+    )
+    arg_parser.add_argument(
+        "-l",
+        "--read-length",
+        dest="read_length",
+        type=int,
+        default=150,
+        help="Lengte van de synthetische reads. Default is 150",
+    )
+    arg_parser.add_argument(
+        "--distribution",
+        dest="distribution",
+        choices=DISTRIBUTIONS,
+        default="fixed",
+        help="Verdeling van de read lengtes. Default is fixed",
+    )
+    arg_parser.add_argument(
+        "--profile",
+        dest="profile",
+        choices=PROFILES,
+        default="illumina",
+        help="Quality profiel van de reads. Default is illumina",
+    )
+    arg_parser.add_argument(
+        "--tricky",
+        dest="tricky",
+        type=float,
+        default=0.0,
+        help="Fractie van de reads waarvan de quality regel met '@' begint",
+    )
+    arg_parser.add_argument(
+        "--mpiexec",
+        dest="mpiexec",
+        default="mpiexec",
+        help="Commando om MPI programma's te starten, bijvoorbeeld "
+        "'mpiexec --oversubscribe'",
+    )
+    return arg_parser.parse_args()
+
+
+def synthetic_file(args, size_mb):
+    """
+    Find or create the synthetic FASTQ file of a size
+    :param args: The command line arguments with the data settings
+    :param size_mb: The size of the file in MB
+    :return: A tuple of the path of the file and its number of reads
+    """
+    os.makedirs(args.data_dir, exist_ok=True)
+    name = (
+        f"synthetic_{size_mb}mb_{args.distribution}{args.read_length}_"
+        f"{args.profile}_t{args.tricky:g}_s{args.seed}.fastq"
+    )
+    path = os.path.join(args.data_dir, name)
+    if not os.path.exists(path):
+        write_fastq(
+            path + ".tmp",
+            num_bytes=size_mb * 1024 * 1024,
+            compression="none",
+            seed=args.seed,
+            read_length=args.read_length,
+            distribution=args.distribution,
+            profile=args.profile,
+            tricky=args.tricky,
+        )
+        os.replace(path + ".tmp", path)
+    with open(path, "rb") as file:
+        num_reads = sum(1 for _ in file) // 4
+    return path, num_reads
+
+
+def python(script, *arguments):
+    """
+    Build the shell command that runs a python script
+    :param script: The path of the script
+    :param arguments: The arguments of the script
+    :return: A shell command
+    """
+    return shlex.join([sys.executable, script] + [str(a) for a in arguments])
+
+
+def serial_engine(args, path, workers, output, port):
+    """
+    The serial baseline: assignment3 reads the whole file in one process
+    """
+    # pylint: disable=unused-argument
+    return [
+        f"{python(SCRIPTS[3], '--chunkmode')} < {shlex.quote(path)} | "
+        f"{python(SCRIPTS[3], '--totalmode')} > {shlex.quote(output)}"
+    ]
+
+
+def pool_engine(args, path, workers, output, port):
+    """
+    Assignment1: a multiprocessing pool
+    """
+    # pylint: disable=unused-argument
+    return [python(SCRIPTS[1], "-n", workers, "-o", output, path)]
+
+
+def manager_engine(args, path, workers, output, port):
+    """
+    Assignment2: a server and one client with the workers
+    """
+    # pylint: disable=unused-argument
+    return [
+        python(SCRIPTS[2], "-s", "-p", port, "-o", output, path),
+        python(SCRIPTS[2], "-c", "-p", port, "-n", workers),
+    ]
+
+
+def parallel_engine(args, path, workers, output, port):
+    """
+    Assignment3: GNU parallel cutting the file into chunks
+    """
+    # pylint: disable=unused-argument
+    return [
+        f"parallel --jobs {workers} --pipepart --recstart @ --block 4M "
+        f"{python(SCRIPTS[3], '--chunkmode', '--chunk-id')} {{#}} "
+        f":::: {shlex.quote(path)} | "
+        f"{python(SCRIPTS[3], '--totalmode')} > {shlex.quote(output)}"
+    ]
+
+
+def mpi_engine(args, path, workers, output, port):
+    """
+    Assignment4: MPI ranks
+    """
+    # pylint: disable=unused-argument
+    return [
+        f"{args.mpiexec} -np {workers} "
+        + python(SCRIPTS[4], "-o", output, path)
+    ]
+
+
+# name: (command builder, programs it needs, whether it scales)
+ENGINES = {
+    "serial": (serial_engine, [], False),
+    "pool": (pool_engine, [], True),
+    "manager": (manager_engine, [], True),
+    "parallel": (parallel_engine, ["parallel"], True),
+    "mpi": (mpi_engine, ["mpiexec"], True),
+}
+
+
+def free_port():
+    """
+    Find a free TCP port for the manager server
+    :return: A port number
+    """
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    """
+    Wait until a server accepts connections
+    :param port: The port on localhost
+    :param timeout: The number of seconds to wait
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(("localhost", port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run(commands, workdir, port):
+    """
+    Run the commands of an engine together and wait for all of them
+    :param commands: A list of shell commands, started in order; every
+    command after the first waits until the server on port is up
+    :param workdir: The directory to run in
+    :param port: The port of the server, if the engine has one
+    :return: A tuple of the wall time in seconds and the peak RSS of the
+    largest process in MB
+    """
+    start = time.perf_counter()
+    processes = []
+    log_path = os.path.join(workdir, "stderr.log")
+    with open(log_path, "ab") as log:
+        for i, command in enumerate(commands):
+            if i:
+                wait_for_port(port)
+            processes.append(
+                # pylint: disable-next=consider-using-with
+                subprocess.Popen(
+                    [
+                        sys.executable,
+                        "-c",
+                        RSS_WRAPPER,
+                        command,
+                        os.path.join(workdir, f"rss{i}"),
+                    ],
+                    cwd=workdir,
+                    stdout=subprocess.DEVNULL,
+                    stderr=log,
+                )
+            )
+        failed = [process.wait() != 0 for process in processes]
+    wall = time.perf_counter() - start
+    if any(failed):
+        with open(log_path, "rb") as log:
+            sys.stderr.write(log.read()[-2000:].decode(errors="replace"))
+        raise RuntimeError(f"Failed: {' & '.join(commands)}")
+    peak_rss = 0
+    for i in range(len(commands)):
+        with open(os.path.join(workdir, f"rss{i}"), encoding="utf-8") as file:
+            peak_rss = max(peak_rss, int(file.read()))
+    # ru_maxrss is in kilobytes on Linux
+    return wall, peak_rss / 1024
+
+
+def read_means(path):
+    """
+    Read the means from the CSV output of any of the engines, which may
+    or may not have an index column
+    :param path: The path of the CSV file
+    :return: An array with the mean of every position
+    """
+    with open(path, encoding="utf-8") as file:
+        return np.array(
+            [float(line.rsplit(",", 1)[-1]) for line in file if line.strip()]
+        )
+
+
+def measure(args, engine, path, workers, expected):
+    """
+    Run an engine a number of times
+    :param args: The command line arguments
+    :param engine: The name of the engine
+    :param path: The path of the FASTQ file
+    :param workers: The number of workers
+    :param expected: The means the output should have
+    :return: A tuple of the median wall time, the peak RSS and whether
+    the output of every run was correct
+    """
+    build = ENGINES[engine][0]
+    walls = []
+    peak_rss = 0
+    correct = True
+    for _ in range(args.repeats):
+        with tempfile.TemporaryDirectory() as workdir:
+            output = os.path.join(workdir, "output.csv")
+            port = free_port() if engine == "manager" else None
+            commands = build(args, path, workers, output, port)
+            wall, rss = run(commands, workdir, port)
+            walls.append(wall)
+            peak_rss = max(peak_rss, rss)
+            means = read_means(output)
+            correct = correct and (
+                means.shape == expected.shape and np.allclose(means, expected)
+            )
+    return statistics.median(walls), peak_rss, correct
+
+
+def current_commit():
+    """
+    Find the commit the benchmark runs on
+    :return: The short hash, or an empty string outside a git checkout
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def available_engines(args):
+    """
+    Drop the engines whose programs are not installed
+    :param args: The command line arguments
+    :return: A list of engine names
+    """
+    engines = []
+    for engine in args.engines:
+        programs = ENGINES[engine][1]
+        if engine == "mpi":
+            programs = [shlex.split(args.mpiexec)[0]]
+        missing = [name for name in programs if shutil.which(name) is None]
+        if missing:
+            print(f"skipping {engine}: {', '.join(missing)} not found")
+        else:
+            engines.append(engine)
+    return engines
+
+
+# MAIN
+def main():
+    """
+    Main function
+    """
+    args = parse_args()
+    engines = available_engines(args)
+    commit = current_commit()
+    new_file = not os.path.exists(args.output)
+    with open(args.output, "a", newline="", encoding="utf-8") as table:
+        writer = csv.DictWriter(table, FIELDS)
+        if new_file:
+            writer.writeheader()
+        print(
+            f"{'engine':<9}{'MB':>6}{'workers':>8}{'sec':>8}{'MB/s':>8}"
+            f"{'RSS MB':>8}{'speedup':>8}{'eff':>6}  ok"
+        )
+        for size_mb in args.sizes:
+            path, num_reads = synthetic_file(args, size_mb)
+            expected = accumulate_range(path, 0, os.path.getsize(path)).means()
+            baseline = None
+            # the serial baseline goes first, so the others can use it
+            for engine in sorted(engines, key=lambda name: name != "serial"):
+                scales = ENGINES[engine][2]
+                for workers in args.workers if scales else [1]:
+                    wall, peak_rss, correct = measure(
+                        args, engine, path, workers, expected
+                    )
+                    if baseline is None:
+                        baseline = wall
+                    speedup = baseline / wall
+                    row = {
+                        "commit": commit,
+                        "engine": engine,
+                        "size_mb": size_mb,
+                        "reads": num_reads,
+                        "workers": workers,
+                        "repeats": args.repeats,
+                        "wall_sec": round(wall, 4),
+                        "mb_per_sec": round(size_mb / wall, 2),
+                        "reads_per_sec": round(num_reads / wall),
+                        "peak_rss_mb": round(peak_rss, 1),
+                        "speedup": round(speedup, 3),
+                        "efficiency": round(speedup / workers, 3),
+                        "correct": correct,
+                    }
+                    writer.writerow(row)
+                    table.flush()
+                    print(
+                        f"{engine:<9}{size_mb:>6}{workers:>8}{wall:>8.2f}"
+                        f"{size_mb / wall:>8.1f}{peak_rss:>8.0f}"
+                        f"{speedup:>8.2f}{speedup / workers:>6.2f}  "
+                        f"{'yes' if correct else 'NO'}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
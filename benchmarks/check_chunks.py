@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+"""
+Check the record boundary handling of assignment3 and the range readers
+against a naive reference.
+
+Every trial writes random FASTQ records in which a fraction of the
+quality lines starts with '@', and cuts the file before random lines
+starting with '@', like GNU parallel --recstart '@' does. Cuts often come
+in pairs around a quality line, so some chunks hold no record start at
+all. Every chunk goes through assignment3 --chunkmode and the results, in
+random order, through --totalmode. The chunks are also reduced in process
+with small stream blocks, and plain and BGZF range readers are split at
+random offsets. Every result must match the sums of the quality lines
+taken one line at a time. The first mismatch or error ends the script
+with a non-zero exit status, the seed and the cut points.
+"""
+
+# IMPORTS
+import argparse as ap
+import io
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from phredlib import PhredAccumulator  # noqa: E402
+from phredlib.chunks import ChunkReducer, ChunkResult  # noqa: E402
+from phredlib.reader import (  # noqa: E402
+    BgzfRangeReader,
+    FastqRangeReader,
+    FastqStream,
+)
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+ASSIGNMENT3 = os.path.join(ROOT, "Assignment3", "assignment3.py")
+# the read lengths of the trials, in turn; long reads span BGZF blocks
+LENGTHS = ["fixed", "variable", "long"]
+LONG_FACTOR = 100
+# uncompressed bytes per BGZF block, as bgzip writes them
+BGZF_BLOCK_SIZE = 0xFF00
+# the gzip header of a BGZF block up to the size in its BC extra field
+BGZF_HEADER = bytes([31, 139, 8, 4, 0, 0, 0, 0, 0, 255, 6, 0, 66, 67, 2, 0])
+# a wrong result, or an error raised on data that is fine
+FAILURES = (AssertionError, ValueError, subprocess.CalledProcessError)
+
+
+# CLASSES
+class CheckFailed(Exception):
+    """
+    A check of a trial gave another result than the reference
+    """
+
+
+# FUNCTIONS
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: An argparse object containing the arguments
+    """
+    arg_parser = ap.ArgumentParser(
+        description="Controleer het knippen van FASTQ files tussen records"
+    )
+    arg_parser.add_argument(
+        "-n",
+        "--reads",
+        dest="num_reads",
+        type=int,
+        default=2000,
+        help="Aantal reads per proef. Default is 2000",
+    )
+    arg_parser.add_argument(
+        "-t",
+        "--trials",
+        dest="trials",
+        type=int,
+        default=6,
+        help="Aantal proeven, om de beurt met vaste, variabele en lange "
+        "reads. Default is 6",
+    )
+    arg_parser.add_argument(
+        "-c",
+        "--cuts",
+        dest="cuts",
+        type=int,
+        default=6,
+        help="Maximaal aantal plekken per proef waar geknipt wordt, vaak "
+        "twee keer vlak na elkaar. Default is 6",
+    )
+    arg_parser.add_argument(
+        "-l",
+        "--read-length",
+        dest="read_length",
+        type=int,
+        default=150,
+        help="Lengte van de reads. Default is 150",
+    )
+    arg_parser.add_argument(
+        "--tricky",
+        dest="tricky",
+        type=float,
+        default=0.3,
+        help="Fractie van de reads waarvan de quality regel met '@' begint. "
+        "Default is 0.3",
+    )
+    arg_parser.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=1,
+        help="Seed van de eerste proef; iedere proef telt er een bij op",
+    )
+    return arg_parser.parse_args()
+
+
+def make_fastq(rng, num_reads, lengths, tricky):
+    """
+    Write random FASTQ records
+    :param rng: A numpy random generator
+    :param num_reads: The number of records
+    :param lengths: An int array with the length of every read
+    :param tricky: The fraction of quality lines that start with '@'
+    :return: The FASTQ text as bytes
+    """
+    records = []
+    for number, length in enumerate(lengths[:num_reads]):
+        sequence = rng.choice(np.frombuffer(b"ACGT", dtype=np.uint8), length)
+        # every PHRED character, so '@' and '+' also occur in the middle
+        quality = rng.integers(33, 75, length, dtype=np.uint8)
+        if rng.random() < tricky:
+            quality[0] = ord("@")
+        records.append(
+            b"@read%d\n%s\n+\n%s\n"
+            % (number, sequence.tobytes(), quality.tobytes())
+        )
+    return b"".join(records)
+
+
+def write_bgzf(path, data):
+    """
+    Compress data into BGZF blocks without an index, so the reader has to
+    find the blocks itself
+    :param path: The path of the new file
+    :param data: The bytes to compress
+    """
+    with open(path, "wb") as file:
+        for start in range(0, len(data), BGZF_BLOCK_SIZE):
+            file.write(bgzf_block(data[start : start + BGZF_BLOCK_SIZE]))
+        # the empty block that ends a BGZF file
+        file.write(bgzf_block(b""))
+
+
+def bgzf_block(data):
+    """
+    Compress bytes into one BGZF block
+    :param data: At most BGZF_BLOCK_SIZE bytes
+    :return: The compressed block
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = BGZF_HEADER + struct.pack("<H", len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def reference_sums(text):
+    """
+    Sum the qualities one quality line at a time, without any of the
+    record boundary logic
+    :param text: FASTQ text of whole records
+    :return: A PhredAccumulator with the sums and counts
+    """
+    total = PhredAccumulator()
+    for line in text.split(b"\n")[3::4]:
+        values = np.frombuffer(line, dtype=np.uint8).astype(np.int64) - 33
+        total.add(values, np.ones(values.size, dtype=np.int64))
+    return total
+
+
+def cut_points(text, rng, max_cuts):
+    """
+    Pick offsets before lines that start with '@' to cut the text at.
+    Half of the picks also cut before the next such line, which makes a
+    chunk of a single quality line if the first one is one.
+    :param text: FASTQ text
+    :param rng: A numpy random generator
+    :param max_cuts: The maximum number of picks
+    :return: A sorted list of offsets
+    """
+    data = np.frombuffer(text, dtype=np.uint8)
+    line_starts = np.flatnonzero(data[:-1] == ord("\n")) + 1
+    candidates = line_starts[data[line_starts] == ord("@")]
+    picks = rng.integers(0, candidates.size, int(rng.integers(1, max_cuts)))
+    pairs = picks[rng.random(picks.size) < 0.5] + 1
+    picks = np.concatenate((picks, pairs[pairs < candidates.size]))
+    return sorted(set(candidates[picks].tolist()))
+
+
+def cut(text, cuts):
+    """
+    Cut text at offsets
+    :param text: Bytes
+    :param cuts: A sorted list of offsets
+    :return: A list of bytes objects
+    """
+    bounds = [0] + cuts + [len(text)]
+    return [text[start:stop] for start, stop in zip(bounds, bounds[1:])]
+
+
+def run_assignment3(chunks, rng):
+    """
+    Run assignment3 --chunkmode on every chunk and --totalmode on the
+    results in random order
+    :param chunks: A list of bytes objects
+    :param rng: A numpy random generator
+    :return: A tuple of the means written by totalmode and the number of
+    chunks without a record start
+    """
+    processes = []
+    for chunk_id, chunk in enumerate(chunks, start=1):
+        # pylint: disable-next=consider-using-with
+        process = subprocess.Popen(
+            [sys.executable, ASSIGNMENT3, "--chunkmode"]
+            + ["--chunk-id", str(chunk_id)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        processes.append((process, chunk))
+    results = []
+    for process, chunk in processes:
+        output, _ = process.communicate(chunk)
+        if process.returncode:
+            raise subprocess.CalledProcessError(
+                process.returncode, "chunkmode"
+            )
+        results.append(output)
+    total = subprocess.run(
+        [sys.executable, ASSIGNMENT3, "--totalmode"],
+        input=b"".join(
+            results[index] for index in rng.permutation(len(results))
+        ),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    unaligned = sum(
+        not result.aligned
+        for result in ChunkResult.iter_from(io.BytesIO(b"".join(results)))
+    )
+    return np.array(total.stdout.split(), dtype=np.float64), unaligned
+
+
+def reduce_chunks(chunks, rng):
+    """
+    Reduce the chunks in process in random order, read with small stream
+    blocks so records also span blocks
+    :param chunks: A list of bytes objects
+    :param rng: A numpy random generator
+    :return: The PhredAccumulator of all chunks
+    """
+    reducer = ChunkReducer()
+    for chunk_id in rng.permutation(len(chunks)):
+        records = FastqStream(
+            io.BytesIO(chunks[chunk_id]), int(rng.integers(1, 4096))
+        )
+        accumulator = PhredAccumulator()
+        for block in records:
+            accumulator.add_block(block)
+        reducer.add(ChunkResult.from_stream(chunk_id, records, accumulator))
+    return reducer.finish()
+
+
+def reduce_ranges(reader, rng):
+    """
+    Split a file at random offsets, which the reader moves to the next
+    record or block start, and add up the ranges
+    :param reader: An open FastqRangeReader or BgzfRangeReader
+    :param rng: A numpy random generator
+    :return: The PhredAccumulator of all ranges
+    """
+    offsets = rng.integers(0, reader.size, int(rng.integers(1, 50)))
+    bounds = sorted(
+        {0, reader.size}
+        | {reader.find_record_start(int(offset)) for offset in offsets}
+    )
+    total = PhredAccumulator()
+    for start, stop in zip(bounds, bounds[1:]):
+        total.merge(reader.accumulate(start, stop - start))
+    return total
+
+
+def run_trial(args, trial, directory):
+    """
+    Write the data of a trial and run every check on it
+    :param args: The command line arguments
+    :param trial: The number of the trial
+    :param directory: A directory for the FASTQ files
+    :return: A description of the trial
+    :raise CheckFailed: If a check does not match the reference or fails
+    on the data, with the seed and the cut points in its message
+    """
+    seed = args.seed + trial
+    rng = np.random.default_rng(seed)
+    kind = LENGTHS[trial % len(LENGTHS)]
+    length = args.read_length
+    if kind == "fixed":
+        lengths = np.full(args.num_reads, length)
+    elif kind == "variable":
+        lengths = rng.integers(1, 2 * length, args.num_reads)
+    else:
+        # few reads, but long enough to span several BGZF blocks
+        lengths = rng.integers(length, LONG_FACTOR * length, args.num_reads)
+        lengths = lengths[: max(args.num_reads // LONG_FACTOR, 2)]
+    text = make_fastq(rng, args.num_reads, lengths, args.tricky)
+    plain = os.path.join(directory, f"trial{trial}.fastq")
+    compressed = os.path.join(directory, f"trial{trial}.fastq.bgz")
+    with open(plain, "wb") as file:
+        file.write(text)
+    write_bgzf(compressed, text)
+    reference = reference_sums(text)
+    cuts = cut_points(text, rng, args.cuts)
+    chunks = cut(text, cuts)
+
+    check = "assignment3"
+    try:
+        means, unaligned = run_assignment3(chunks, rng)
+        if not np.allclose(means, reference.means(), rtol=1e-12, atol=0):
+            raise AssertionError("the means of totalmode differ")
+        check = "stream blocks"
+        if reduce_chunks(chunks, rng).trim() != reference:
+            raise AssertionError("the sums differ")
+        for reader in (FastqRangeReader(plain), BgzfRangeReader(compressed)):
+            check = type(reader).__name__
+            with reader:
+                if reduce_ranges(reader, rng).trim() != reference:
+                    raise AssertionError("the sums differ")
+    except FAILURES as error:
+        raise CheckFailed(
+            f"trial {trial} ({kind} reads) failed in {check}: {error}\n"
+            f"seed {seed}, cut points {cuts}"
+        ) from error
+    return (
+        f"trial {trial} ({kind} reads, seed {seed}): {len(chunks)} chunks, "
+        f"{unaligned} without a record start, ok"
+    )
+
+
+# MAIN
+def main():
+    """
+    Main function
+    """
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        for trial in range(args.trials):
+            try:
+                print(run_trial(args, trial, directory))
+            except CheckFailed as error:
+                sys.exit(str(error))
+    print("All record boundaries are handled correctly")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""
+Write a synthetic FASTQ file to benchmark or test the assignments
+without the rnaseq.fastq file on the cluster.
+"""
+
+# IMPORTS
+import argparse as ap
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from phredlib.synthetic import (  # noqa: E402
+    COMPRESSIONS,
+    DISTRIBUTIONS,
+    PROFILES,
+    write_fastq,
+)
+
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+# FUNCTIONS
+def parse_size(value):
+    """
+    Argparse type for a size in bytes with an optional K, M, G or T
+    :param value: The command line value, for example 512M or 10G
+    :return: The size in bytes
+    """
+    number = value.upper().removesuffix("B")
+    factor = UNITS.get(number[-1:], 1)
+    if number[-1:] in UNITS:
+        number = number[:-1]
+    try:
+        size = int(float(number) * factor)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise ap.ArgumentTypeError(f"invalid size {value!r}")
+    return size
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: An argparse object containing the arguments
+    """
+    arg_parser = ap.ArgumentParser(
+        description="Maak een synthetische FASTQ file"
+    )
+    arg_parser.add_argument(
+        "output",
+        help="Pad van de nieuwe file, of - voor STDOUT. Een .gz extensie "
+        "geeft gzip, .bgz geeft BGZF met een .gzi index",
+    )
+    amount = arg_parser.add_mutually_exclusive_group(required=True)
+    amount.add_argument(
+        "-n",
+        "--reads",
+        dest="num_reads",
+        type=int,
+        help="Aantal reads",
+    )
+    amount.add_argument(
+        "-s",
+        "--size",
+        dest="num_bytes",
+        type=parse_size,
+        help="Grootte van de ongecomprimeerde data, bijvoorbeeld 512M of 10G",
+    )
+    arg_parser.add_argument(
+        "-l",
+        "--read-length",
+        dest="read_length",
+        type=int,
+        default=150,
+        help="Lengte van de reads; de mediaan bij --distribution long. "
+        "Default is 150",
+    )
+    arg_parser.add_argument(
+        "--distribution",
+        dest="distribution",
+        choices=DISTRIBUTIONS,
+        default="fixed",
+        help="Verdeling van de read lengtes: fixed, variable (normaal) of "
+        "long (lognormaal). Default is fixed",
+    )
+    arg_parser.add_argument(
+        "--length-sd",
+        dest="length_sd",
+        type=float,
+        help="Standaarddeviatie van de read lengte bij variable, of van de "
+        "log van de lengte bij long",
+    )
+    arg_parser.add_argument(
+        "--profile",
+        dest="profile",
+        choices=PROFILES,
+        default="illumina",
+        help="Quality profiel. Default is illumina",
+    )
+    arg_parser.add_argument(
+        "--tricky",
+        dest="tricky",
+        type=float,
+        default=0.0,
+        help="Fractie van de reads waarvan de quality regel met '@' begint",
+    )
+    arg_parser.add_argument(
+        "--compression",
+        dest="compression",
+        choices=COMPRESSIONS,
+        help="Compressie; default volgt uit de extensie van de output",
+    )
+    arg_parser.add_argument(
+        "--level",
+        dest="level",
+        type=int,
+        default=1,
+        help="Compressie niveau. Default is 1",
+    )
+    arg_parser.add_argument(
+        "--threads",
+        dest="threads",
+        type=int,
+        default=1,
+        help="Aantal threads voor BGZF compressie",
+    )
+    arg_parser.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=42,
+        help="Seed voor de random generator. Default is 42",
+    )
+    return arg_parser.parse_args()
+
+
+# MAIN
+def main():
+    """
+    Main function
+    """
+    args = parse_args()
+    start = time.perf_counter()
+    num_reads, num_bytes = write_fastq(
+        args.output,
+        num_reads=args.num_reads,
+        num_bytes=args.num_bytes,
+        compression=args.compression,
+        level=args.level,
+        threads=args.threads,
+        seed=args.seed,
+        read_length=args.read_length,
+        distribution=args.distribution,
+        length_sd=args.length_sd,
+        profile=args.profile,
+        tricky=args.tricky,
+    )
+    runtime = time.perf_counter() - start
+    print(
+        f"{num_reads} reads, {num_bytes / 1e6:.1f} MB in {runtime:.2f} sec "
+        f"({num_bytes / 1e6 / runtime:.0f} MB/s)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""
+Shared building blocks for the Big Data Computing assignments.
+"""
+
+from phredlib.engine import (
+    PHRED_OFFSET,
+    block_quality_sums,
+    mean_from_sums,
+    quality_sums,
+)
+from phredlib.accumulator import PhredAccumulator
+from phredlib.reader import BgzfRangeReader, FastqRangeReader
+from phredlib.tuning import BatchSizer
+
+__all__ = [
+    "BatchSizer",
+    "BgzfRangeReader",
+    "PHRED_OFFSET",
+    "FastqRangeReader",
+    "PhredAccumulator",
+    "block_quality_sums",
+    "mean_from_sums",
+    "quality_sums",
+]
@@ -0,0 +1,218 @@
+"""
+Streaming per-position PHRED accumulator.
+
+Instead of averaging per-batch means, which is wrong as soon as batches
+differ in size or reads differ in length, every batch is folded into
+exact int64 sums and counts per base position.
+"""
+
+# IMPORTS
+import struct
+
+import numpy as np
+
+from phredlib import engine
+
+# CONSTANTS
+MAGIC = b"PHRA"
+HEADER = struct.Struct("<4sQ")
+
+
+# CLASSES
+class PhredAccumulator:
+    """
+    Keep the summed PHRED scores and the number of reads for every base
+    position, so results can be combined exactly in any order.
+    """
+
+    def __init__(self, sums=None, counts=None):
+        if sums is None:
+            sums, counts = engine.empty_result()
+        self.sums = np.asarray(sums, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        if self.sums.shape != self.counts.shape:
+            raise ValueError("sums and counts must have the same length")
+
+    def __len__(self):
+        return self.sums.size
+
+    def __eq__(self, other):
+        if not isinstance(other, PhredAccumulator):
+            return NotImplemented
+        return np.array_equal(self.sums, other.sums) and np.array_equal(
+            self.counts, other.counts
+        )
+
+    def __repr__(self):
+        return (
+            f"PhredAccumulator(positions={len(self)}, "
+            f"reads={self.num_reads})"
+        )
+
+    @property
+    def num_reads(self):
+        """
+        The number of reads folded into this accumulator
+        :return: The read count, which equals the coverage of position 0
+        """
+        return int(self.counts[0]) if self.counts.size else 0
+
+    def _grow(self, size):
+        """
+        Make room for at least size base positions
+        :param size: The required number of positions
+        """
+        if size > self.sums.size:
+            extra = size - self.sums.size
+            self.sums = np.concatenate(
+                (self.sums, np.zeros(extra, dtype=np.int64))
+            )
+            self.counts = np.concatenate(
+                (self.counts, np.zeros(extra, dtype=np.int64))
+            )
+
+    def add(self, sums, counts):
+        """
+        Fold per-position sums and counts into the accumulator
+        :param sums: An int64 array with summed scores per position
+        :param counts: An int64 array with read counts per position
+        :return: The accumulator itself
+        """
+        size = len(sums)
+        self._grow(size)
+        self.sums[:size] += sums
+        self.counts[:size] += counts
+        return self
+
+    def add_batch(self, batch):
+        """
+        Decode a batch of quality lines and fold it into the accumulator
+        :param batch: A batch of quality lines as bytes
+        :return: The accumulator itself
+        """
+        return self.add(*engine.quality_sums(batch))
+
+    def add_block(self, buffer):
+        """
+        Decode a buffer of complete FASTQ records and fold it in
+        :param buffer: A bytes-like object that starts at a record header
+        :return: The accumulator itself
+        """
+        return self.add(*engine.block_quality_sums(buffer))
+
+    def merge(self, other):
+        """
+        Fold another accumulator into this one
+        :param other: The PhredAccumulator to merge
+        :return: The accumulator itself
+        """
+        return self.add(other.sums, other.counts)
+
+    def trim(self):
+        """
+        Drop trailing base positions that no read reaches, for example
+        when the arrays were allocated with a fixed capacity
+        :return: The accumulator itself
+        """
+        covered = np.flatnonzero(self.counts)
+        size = covered[-1] + 1 if covered.size else 0
+        self.sums = self.sums[:size]
+        self.counts = self.counts[:size]
+        return self
+
+    @classmethod
+    def from_batch(cls, batch):
+        """
+        Create an accumulator for a single batch of quality lines
+        :param batch: A batch of quality lines as bytes
+        :return: A new PhredAccumulator
+        """
+        return cls(*engine.quality_sums(batch))
+
+    @classmethod
+    def combine(cls, accumulators):
+        """
+        Merge any number of accumulators into a new one
+        :param accumulators: An iterable of PhredAccumulator objects
+        :return: A new PhredAccumulator holding the total
+        """
+        total = cls()
+        for accumulator in accumulators:
+            total.merge(accumulator)
+        return total
+
+    def means(self):
+        """
+        Calculate the mean PHRED score per base position
+        :return: A float64 array with the mean score per position
+        """
+        return engine.mean_from_sums(self.sums, self.counts)
+
+    def to_bytes(self):
+        """
+        Serialize the accumulator to a compact little-endian byte string
+        :return: The serialized accumulator
+        """
+        return (
+            HEADER.pack(MAGIC, self.sums.size)
+            + self.sums.astype("<i8").tobytes()
+            + self.counts.astype("<i8").tobytes()
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Restore an accumulator serialized with to_bytes
+        :param data: A bytes-like object
+        :return: A new PhredAccumulator
+        """
+        magic, size = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a serialized PhredAccumulator")
+        if len(data) != HEADER.size + 16 * size:
+            raise ValueError("Serialized PhredAccumulator has the wrong size")
+        arrays = np.frombuffer(data, dtype="<i8", offset=HEADER.size)
+        return cls(arrays[:size].copy(), arrays[size:].copy())
+
+    def write_to(self, stream):
+        """
+        Write the accumulator as a single record to a binary stream; the
+        header holds the number of positions, so records can follow each
+        other without a separator
+        :param stream: A binary file object, for example sys.stdout.buffer
+        """
+        stream.write(self.to_bytes())
+
+    @classmethod
+    def read_from(cls, stream):
+        """
+        Read the next record written with write_to from a binary stream
+        :param stream: A binary file object, for example sys.stdin.buffer
+        :return: A new PhredAccumulator, or None at the end of the stream
+        """
+        header = stream.read(HEADER.size)
+        if not header:
+            return None
+        if len(header) < HEADER.size:
+            raise ValueError("Serialized PhredAccumulator is truncated")
+        magic, size = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("Not a serialized PhredAccumulator")
+        payload = stream.read(16 * size)
+        if len(payload) != 16 * size:
+            raise ValueError("Serialized PhredAccumulator is truncated")
+        arrays = np.frombuffer(payload, dtype="<i8")
+        return cls(arrays[:size].copy(), arrays[size:].copy())
+
+    @classmethod
+    def iter_from(cls, stream):
+        """
+        Read records written with write_to until the stream ends
+        :param stream: A binary file object
+        :return: A generator of PhredAccumulator objects
+        """
+        while True:
+            accumulator = cls.read_from(stream)
+            if accumulator is None:
+                return
+            yield accumulator
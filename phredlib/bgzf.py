@@ -0,0 +1,273 @@
+"""
+Gzip and BGZF support.
+
+A BGZF file (as written by bgzip) is a series of independent gzip members
+of at most 64 KB each, whose compressed size is stored in the header. The
+block starts can therefore be found without decompressing anything, and
+every block can be decompressed on its own, so workers can each take a
+run of blocks. A plain gzip file is one stream that can only be read from
+the start.
+"""
+
+# IMPORTS
+import functools
+import gzip
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# CONSTANTS
+GZIP_MAGIC = b"\x1f\x8b"
+# gzip magic, deflate, FEXTRA flag
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+FIXED_HEADER = 12
+TRAILER = struct.Struct("<II")
+# the index written by bgzip -i next to the file
+INDEX_SUFFIX = ".gzi"
+# the uncompressed bytes per block that bgzip uses, so a block that does
+# not compress still fits in 64 KB
+BLOCK_DATA_SIZE = 0xFF00
+# the empty block that marks the end of a BGZF file
+EOF_BLOCK = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+
+
+# FUNCTIONS
+def read_magic(path, size=4):
+    """
+    Read the first bytes of a file
+    :param path: The path of the file
+    :param size: The number of bytes to read
+    :return: Up to size bytes
+    """
+    with open(path, "rb") as file:
+        return file.read(size)
+
+
+def is_gzip(path):
+    """
+    Check whether a file is gzip compressed, BGZF included
+    :param path: The path of the file
+    :return: True if the file starts with the gzip magic bytes
+    """
+    return read_magic(path, 2) == GZIP_MAGIC
+
+
+def is_bgzf(path):
+    """
+    Check whether a file is BGZF compressed
+    :param path: The path of the file
+    :return: True if the first block has a BGZF block size field
+    """
+    with open(path, "rb") as file:
+        header = file.read(FIXED_HEADER)
+        if len(header) < FIXED_HEADER or header[:4] != BGZF_MAGIC:
+            return False
+        extra = file.read(struct.unpack_from("<H", header, 10)[0])
+    return extra_block_size(extra) is not None
+
+
+def extra_block_size(extra):
+    """
+    Find the BSIZE subfield in the extra field of a gzip header
+    :param extra: The bytes of the extra field
+    :return: The total size of the block in bytes, or None if the field
+    is missing
+    """
+    position = 0
+    while position + 4 <= len(extra):
+        sub_id = bytes(extra[position : position + 2])
+        length = struct.unpack_from("<H", extra, position + 2)[0]
+        if sub_id == b"BC" and length == 2:
+            return struct.unpack_from("<H", extra, position + 4)[0] + 1
+        position += 4 + length
+    return None
+
+
+def block_size(data, offset):
+    """
+    Read the size of the BGZF block that starts at offset
+    :param data: A bytes-like object holding the compressed file
+    :param offset: The start of a block
+    :return: A tuple of the size of the block header and the whole block
+    """
+    if bytes(data[offset : offset + 4]) != BGZF_MAGIC:
+        raise ValueError(f"No BGZF block starts at offset {offset}")
+    extra_length = struct.unpack_from("<H", data, offset + 10)[0]
+    header = FIXED_HEADER + extra_length
+    size = extra_block_size(data[offset + FIXED_HEADER : offset + header])
+    if size is None:
+        raise ValueError(f"No BGZF block starts at offset {offset}")
+    return header, size
+
+
+def read_index(path):
+    """
+    Read the block starts from the .gzi index that bgzip -i writes
+    :param path: The path of the BGZF file
+    :return: A list of compressed block offsets, or None without an index
+    """
+    index_path = path + INDEX_SUFFIX
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path, "rb") as file:
+        data = file.read()
+    (count,) = struct.unpack_from("<Q", data)
+    entries = struct.unpack_from(f"<{2 * count}Q", data, 8)
+    # the index lists (compressed, uncompressed) offsets of all blocks but
+    # the first one
+    return [0] + list(entries[::2])
+
+
+def block_offsets(data):
+    """
+    Walk the block headers of a BGZF file
+    :param data: A bytes-like object holding the compressed file
+    :return: A list with the offset of every block
+    """
+    offsets = []
+    offset = 0
+    while offset < len(data):
+        offsets.append(offset)
+        offset += block_size(data, offset)[1]
+    return offsets
+
+
+def decompress_block(data, offset):
+    """
+    Decompress a single BGZF block and check its CRC
+    :param data: A bytes-like object holding the compressed file
+    :param offset: The start of the block
+    :return: A tuple of the uncompressed bytes and the size of the block
+    """
+    header, size = block_size(data, offset)
+    trailer = offset + size - TRAILER.size
+    block = zlib.decompress(data[offset + header : trailer], -zlib.MAX_WBITS)
+    crc, length = TRAILER.unpack_from(data, trailer)
+    if length != len(block) or crc != zlib.crc32(block):
+        raise ValueError(f"Corrupt BGZF block at offset {offset}")
+    return block, size
+
+
+def decompress_range(data, offset, length):
+    """
+    Decompress a run of whole BGZF blocks
+    :param data: A bytes-like object holding the compressed file
+    :param offset: The start of the first block
+    :param length: The compressed length of the run, ending at a block end
+    :return: The uncompressed bytes of the run
+    """
+    end = offset + length
+    blocks = []
+    while offset < end:
+        block, size = decompress_block(data, offset)
+        blocks.append(block)
+        offset += size
+    return b"".join(blocks)
+
+
+def compress_block(data, level=6):
+    """
+    Compress up to BLOCK_DATA_SIZE bytes into a single BGZF block
+    :param data: The bytes to compress
+    :param level: The zlib compression level
+    :return: The bytes of the block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = FIXED_HEADER + 6 + len(deflated) + TRAILER.size
+    header = BGZF_MAGIC + struct.pack(
+        "<IBBH2sHH", 0, 0, 0xFF, 6, b"BC", 2, size - 1
+    )
+    return header + deflated + TRAILER.pack(zlib.crc32(data), len(data))
+
+
+class BgzfWriter:
+    """
+    Write a BGZF file, optionally with the .gzi index that bgzip -i
+    writes, so it can be split into block ranges like a bgzip file.
+    zlib releases the GIL, so with more than one thread the blocks are
+    compressed in parallel.
+    """
+
+    def __init__(self, path, level=6, index=False, threads=1):
+        self.path = path
+        self.index = [] if index else None
+        self._compress = functools.partial(compress_block, level=level)
+        self._pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        # pylint: disable-next=consider-using-with
+        self._file = open(path, "wb")
+        self._buffer = bytearray()
+        self._compressed = 0
+        self._uncompressed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        """
+        Add data to the file; full blocks are compressed right away
+        :param data: A bytes-like object
+        """
+        self._buffer += data
+        full = len(self._buffer) - len(self._buffer) % BLOCK_DATA_SIZE
+        chunks = [
+            bytes(self._buffer[start : start + BLOCK_DATA_SIZE])
+            for start in range(0, full, BLOCK_DATA_SIZE)
+        ]
+        del self._buffer[:full]
+        self._write_blocks(chunks)
+
+    def _write_blocks(self, chunks):
+        """
+        Compress and write blocks and note their starts in the index
+        :param chunks: A list of at most BLOCK_DATA_SIZE bytes each
+        """
+        if self._pool is None:
+            blocks = map(self._compress, chunks)
+        else:
+            blocks = self._pool.map(self._compress, chunks)
+        for chunk, block in zip(chunks, blocks):
+            if self.index is not None and self._compressed:
+                self.index.append((self._compressed, self._uncompressed))
+            self._file.write(block)
+            self._compressed += len(block)
+            self._uncompressed += len(chunk)
+
+    def close(self):
+        """
+        Write the last block, the end of file marker and the index
+        """
+        if self._file is None:
+            return
+        if self._buffer:
+            self._write_blocks([bytes(self._buffer)])
+            self._buffer = bytearray()
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._file.write(EOF_BLOCK)
+        self._file.close()
+        self._file = None
+        if self.index is not None:
+            with open(self.path + INDEX_SUFFIX, "wb") as file:
+                file.write(struct.pack("<Q", len(self.index)))
+                for offsets in self.index:
+                    file.write(struct.pack("<QQ", *offsets))
+
+
+def open_fastq(file):
+    """
+    Wrap an open binary file in a gzip reader if it is gzip compressed,
+    so it can be read line by line either way
+    :param file: A binary file object, for example sys.stdin.buffer
+    :return: A binary file object with the uncompressed data
+    """
+    peek = getattr(file, "peek", None)
+    if peek is not None and peek(2)[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=file, mode="rb")
+    return file
@@ -0,0 +1,227 @@
+"""
+Results of FASTQ chunks that were cut at arbitrary line starts.
+
+A tool like GNU parallel cuts a file before lines that start with '@',
+which may be a quality line instead of a header. A chunk only decodes the
+records that start inside it and passes the fragments at its edges on,
+so the reducer can join the fragments of neighbouring chunks into whole
+records again.
+
+To avoid starting a new process for every chunk, chunks can also be sent
+as frames over one stream to a long-lived worker. A frame is a text
+header line, starting with a marker byte that never occurs in FASTQ
+text, followed by the chunk itself.
+"""
+
+# IMPORTS
+import struct
+
+from phredlib import engine
+from phredlib.accumulator import PhredAccumulator
+from phredlib.reader import records_end
+
+# CONSTANTS
+MAGIC = b"PHRC"
+# magic, chunk id, whether a record starts in the chunk, head and tail size
+HEADER = struct.Struct("<4sQ?QQ")
+# the ASCII record separator, so tools like GNU parallel can split a
+# stream of frames with --recstart
+FRAME_MARKER = b"\x1eFRAME"
+FRAME_SIZE = 16 * 1024 * 1024
+
+
+# CLASSES
+class ChunkResult:
+    """
+    The sums and counts of the whole records in a chunk, together with
+    the bytes before its first record start (head) and the incomplete
+    record at its end (tail).
+    """
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(
+        self, chunk_id, accumulator, head=b"", tail=b"", aligned=True
+    ):
+        self.chunk_id = chunk_id
+        self.accumulator = accumulator
+        self.head = bytes(head)
+        self.tail = bytes(tail)
+        self.aligned = aligned
+
+    @classmethod
+    def from_stream(cls, chunk_id, records, accumulator):
+        """
+        Create the result of a chunk read with a FastqStream
+        :param chunk_id: The sequence number of the chunk in the file
+        :param records: The FastqStream, after it has been read
+        :param accumulator: The PhredAccumulator of its records
+        :return: A new ChunkResult
+        """
+        return cls(
+            chunk_id, accumulator, records.head, records.tail, records.aligned
+        )
+
+    def write_to(self, stream):
+        """
+        Write the result as a single length-prefixed record
+        :param stream: A binary file object, for example sys.stdout.buffer
+        """
+        stream.write(
+            HEADER.pack(
+                MAGIC,
+                self.chunk_id,
+                self.aligned,
+                len(self.head),
+                len(self.tail),
+            )
+            + self.head
+            + self.tail
+        )
+        self.accumulator.write_to(stream)
+
+    @classmethod
+    def read_from(cls, stream):
+        """
+        Read the next result written with write_to
+        :param stream: A binary file object, for example sys.stdin.buffer
+        :return: A new ChunkResult, or None at the end of the stream
+        """
+        header = stream.read(HEADER.size)
+        if not header:
+            return None
+        if len(header) < HEADER.size:
+            raise ValueError("Chunk result is truncated")
+        magic, chunk_id, aligned, head_size, tail_size = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("Not a chunk result")
+        head = stream.read(head_size)
+        tail = stream.read(tail_size)
+        accumulator = PhredAccumulator.read_from(stream)
+        if (
+            len(head) + len(tail) != head_size + tail_size
+            or accumulator is None
+        ):
+            raise ValueError("Chunk result is truncated")
+        return cls(chunk_id, accumulator, head, tail, aligned)
+
+    @classmethod
+    def iter_from(cls, stream):
+        """
+        Read results written with write_to until the stream ends
+        :param stream: A binary file object
+        :return: A generator of ChunkResult objects
+        """
+        while True:
+            result = cls.read_from(stream)
+            if result is None:
+                return
+            yield result
+
+
+class ChunkReducer:
+    """
+    Fold the results of all chunks of a file into one total. Sums and
+    counts are added as they arrive; the edge fragments are kept until
+    the end, when they are joined in chunk order and decoded.
+    """
+
+    def __init__(self):
+        self.total = PhredAccumulator()
+        self.fragments = {}
+
+    def add(self, result):
+        """
+        Fold in the result of a chunk
+        :param result: A ChunkResult
+        """
+        self.total.merge(result.accumulator)
+        if result.chunk_id in self.fragments:
+            raise ValueError(f"Chunk {result.chunk_id} was seen twice")
+        self.fragments[result.chunk_id] = (
+            result.head,
+            result.aligned,
+            result.tail,
+        )
+
+    def finish(self):
+        """
+        Join the fragments of neighbouring chunks into whole records and
+        add them to the total
+        :return: The PhredAccumulator of the whole file
+        """
+        chunk_ids = sorted(self.fragments)
+        if chunk_ids and chunk_ids[-1] - chunk_ids[0] + 1 != len(chunk_ids):
+            raise ValueError("Chunks are missing from the input")
+        if chunk_ids:
+            head, aligned, _ = self.fragments[chunk_ids[0]]
+            if head and aligned:
+                raise ValueError(
+                    "The first chunk does not start with a record"
+                )
+        pending = b""
+        for chunk_id in chunk_ids:
+            head, aligned, tail = self.fragments[chunk_id]
+            pending += head
+            if aligned:
+                # the tail of the previous chunk ended where this one starts
+                self.total.add(*engine.block_quality_sums(pending))
+                pending = tail
+        # the chunks at the end of the file may hold no record start
+        if records_end(pending, at_eof=True) != len(pending):
+            raise ValueError("The last chunk ends inside a record")
+        self.total.add(*engine.block_quality_sums(pending))
+        self.fragments = {}
+        return self.total
+
+
+# FUNCTIONS
+def cut_frames(stream, frame_size=FRAME_SIZE):
+    """
+    Cut a stream of FASTQ text into chunks of about frame_size bytes that
+    end at a line end; records may still be cut in two
+    :param stream: A binary file object
+    :param frame_size: The number of bytes to read per chunk
+    :return: A generator of bytes objects
+    """
+    carry = b""
+    while True:
+        chunk = stream.read(frame_size)
+        if not chunk:
+            break
+        buffer = carry + chunk
+        end = buffer.rfind(b"\n") + 1
+        carry = buffer[end:]
+        if end:
+            yield buffer[:end]
+    if carry:
+        yield carry
+
+
+def write_frame(stream, chunk_id, payload):
+    """
+    Write a chunk as a frame
+    :param stream: A binary file object
+    :param chunk_id: The sequence number of the chunk in the file
+    :param payload: The bytes of the chunk
+    """
+    stream.write(b"%s %d %d\n" % (FRAME_MARKER, chunk_id, len(payload)))
+    stream.write(payload)
+
+
+def read_frames(stream):
+    """
+    Read frames written with write_frame until the stream ends
+    :param stream: A binary file object
+    :return: A generator of (chunk id, payload) tuples
+    """
+    while True:
+        header = stream.readline()
+        if not header:
+            return
+        marker, chunk_id, length = header.split()
+        if marker != FRAME_MARKER:
+            raise ValueError("Not a frame header")
+        payload = stream.read(int(length))
+        if len(payload) != int(length):
+            raise ValueError("Frame is truncated")
+        yield int(chunk_id), payload
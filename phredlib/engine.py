@@ -0,0 +1,154 @@
+"""
+Vectorized PHRED decoding engine shared by the assignment scripts.
+
+Quality lines are handled as raw bytes: a whole batch is turned into a
+single uint8 buffer with ``np.frombuffer`` and reduced to per-position
+sums and counts without touching individual characters in Python.
+"""
+
+# IMPORTS
+import numpy as np
+
+# CONSTANTS
+PHRED_OFFSET = 33
+MIN_QUALITY_BYTE = 33
+MAX_QUALITY_BYTE = 126
+NEWLINE = 10
+CARRIAGE_RETURN = 13
+
+
+# FUNCTIONS
+def empty_result():
+    """
+    Return the (sums, counts) pair of a batch without any reads
+    :return: Two empty int64 arrays
+    """
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+
+def as_bytes(line):
+    """
+    Return a single quality line as bytes without surrounding whitespace
+    :param line: A quality line as str or bytes
+    :return: The stripped line as bytes
+    """
+    if isinstance(line, str):
+        return line.strip().encode("ascii")
+    return bytes(line).strip()
+
+
+def position_counts(lengths, max_length):
+    """
+    Count how many reads cover each base position
+    :param lengths: An int64 array with the length of every read
+    :param max_length: The length of the longest read
+    :return: An int64 array where item p is the number of reads longer than p
+    """
+    per_length = np.bincount(lengths, minlength=max_length + 1)
+    return np.cumsum(per_length[::-1])[::-1][1:].astype(np.int64)
+
+
+def check_quality_bytes(values):
+    """
+    Make sure every byte is a printable PHRED character
+    :param values: A uint8 array of quality characters
+    """
+    if values.size and (
+        values.min() < MIN_QUALITY_BYTE or values.max() > MAX_QUALITY_BYTE
+    ):
+        raise ValueError("Quality line contains a non-PHRED character")
+
+
+def segment_sums(data, starts, lengths, offset=PHRED_OFFSET):
+    """
+    Sum PHRED scores per base position over segments of a byte buffer
+    :param data: A uint8 array holding the quality characters
+    :param starts: An int64 array with the start of every quality line
+    :param lengths: An int64 array with the length of every quality line
+    :param offset: The ASCII offset of the quality encoding
+    :return: A tuple of int64 arrays (sums, counts) per base position
+    """
+    if lengths.size == 0 or lengths.max() == 0:
+        return empty_result()
+    max_length = int(lengths.max())
+    counts = position_counts(lengths, max_length)
+
+    if lengths.min() == max_length:
+        # all reads have the same length, so one 2D gather does the job
+        matrix = data[starts[:, None] + np.arange(max_length)]
+        check_quality_bytes(matrix)
+        sums = matrix.sum(axis=0, dtype=np.int64)
+    else:
+        # variable read lengths, sum every byte into its base position
+        total = int(lengths.sum())
+        line_ends = np.cumsum(lengths)
+        positions = np.arange(total) - np.repeat(line_ends - lengths, lengths)
+        values = data[np.repeat(starts, lengths) + positions]
+        check_quality_bytes(values)
+        sums = np.bincount(positions, weights=values, minlength=max_length)
+        sums = np.rint(sums).astype(np.int64)
+
+    return sums - offset * counts, counts
+
+
+def quality_sums(lines, offset=PHRED_OFFSET):
+    """
+    Decode a batch of quality lines into per-position sums and counts
+    :param lines: An iterable of quality lines as bytes or str
+    :param offset: The ASCII offset of the quality encoding
+    :return: A tuple of int64 arrays (sums, counts) per base position
+    """
+    lines = [as_bytes(line) for line in lines]
+    if not lines:
+        return empty_result()
+    data = np.frombuffer(b"".join(lines), dtype=np.uint8)
+    lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+    starts = np.cumsum(lengths) - lengths
+
+    max_length = int(lengths.max()) if lengths.size else 0
+    if max_length and lengths.min() == max_length:
+        # contiguous rows of equal length, no gather needed
+        matrix = data.reshape(len(lines), max_length)
+        check_quality_bytes(matrix)
+        sums = matrix.sum(axis=0, dtype=np.int64)
+        counts = np.full(max_length, len(lines), dtype=np.int64)
+        return sums - offset * counts, counts
+
+    return segment_sums(data, starts, lengths, offset)
+
+
+def block_quality_sums(buffer, offset=PHRED_OFFSET):
+    """
+    Decode a buffer of complete four-line FASTQ records into per-position
+    sums and counts
+    :param buffer: A bytes-like object that starts at a record header
+    :param offset: The ASCII offset of the quality encoding
+    :return: A tuple of int64 arrays (sums, counts) per base position
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size == 0:
+        return empty_result()
+    newlines = np.flatnonzero(data == NEWLINE)
+    if data[-1] != NEWLINE:
+        # the last line of the buffer has no trailing newline
+        newlines = np.append(newlines, data.size)
+
+    num_records = newlines.size // 4
+    starts = newlines[2 : 4 * num_records : 4] + 1
+    ends = newlines[3 : 4 * num_records : 4]
+    # Windows line endings
+    ends = ends - (data[np.maximum(ends - 1, 0)] == CARRIAGE_RETURN).astype(
+        np.int64
+    )
+    return segment_sums(data, starts, ends - starts, offset)
+
+
+def mean_from_sums(sums, counts):
+    """
+    Turn per-position sums and counts into mean PHRED scores
+    :param sums: An int64 array with the summed scores per position
+    :param counts: An int64 array with the number of reads per position
+    :return: A float64 array with the mean score per position
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
@@ -0,0 +1,419 @@
+"""
+Memory-mapped FASTQ reader that splits a file into byte ranges.
+
+Every range starts at a real record header, so workers can each parse
+their own part of the file straight from the mapping without a serial
+read in a controller process. BGZF compressed files are split at block
+starts instead, and every worker decompresses its own blocks.
+"""
+
+# IMPORTS
+import bisect
+import contextlib
+import mmap
+import os
+import traceback
+
+import numpy as np
+
+from phredlib import bgzf
+from phredlib.accumulator import PhredAccumulator
+
+# CONSTANTS
+BLOCK_SIZE = 16 * 1024 * 1024
+# blocks read from a stream are smaller, as they are copied
+STREAM_BLOCK_SIZE = 4 * 1024 * 1024
+HEADER_START = ord("@")
+SEPARATOR_START = ord("+")
+
+
+# CLASSES
+class FastqRangeReader:
+    """
+    Map a FASTQ file into memory and hand out (offset, length) ranges
+    that each contain only complete four-line records.
+    """
+
+    def __init__(self, path, data=None):
+        self.path = path
+        # a reader over a buffer in memory needs no path
+        self.size = os.path.getsize(path) if data is None else len(data)
+        self._file = None
+        self.data = data
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        """
+        Map the file into memory; an empty file gets an empty buffer
+        """
+        if self.data is not None:
+            return
+        if self.size == 0:
+            self.data = b""
+            return
+        # pylint: disable-next=consider-using-with
+        self._file = open(self.path, "rb")
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """
+        Release the memory map and the underlying file
+        """
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self.data = None
+
+    def _next_line(self, position):
+        """
+        Find the start of the line after the one containing position
+        :param position: A byte offset in the file
+        :return: The offset of the next line, or the file size at the end
+        """
+        newline = self.data.find(b"\n", position)
+        return self.size if newline == -1 else newline + 1
+
+    def is_record_start(self, position):
+        """
+        Check whether a line start is the header of a FASTQ record.
+
+        A quality line may also start with '@', but two lines after a
+        quality line comes a sequence line, while two lines after a
+        header comes the '+' separator, which tells the two apart.
+        :param position: The offset of the start of a line
+        :return: True if a record starts at position
+        """
+        if position >= self.size or self.data[position] != HEADER_START:
+            return False
+        separator = self._next_line(self._next_line(position))
+        return (
+            separator < self.size and self.data[separator] == SEPARATOR_START
+        )
+
+    def find_record_start(self, position, end=None):
+        """
+        Snap a byte offset forward to the first record that starts there
+        or later
+        :param position: A byte offset in the file
+        :param end: Do not look past this offset, defaults to the file size
+        :return: The offset of the next record start, or end if there is none
+        """
+        end = self.size if end is None else end
+        if position <= 0:
+            return 0
+        # move to the start of the line that follows position - 1
+        line_start = self._next_line(position - 1)
+        while line_start < end:
+            if self.is_record_start(line_start):
+                return line_start
+            line_start = self._next_line(line_start)
+        return end
+
+    def split(self, num_ranges):
+        """
+        Split the file into at most num_ranges parts of similar size
+        :param num_ranges: The number of ranges wanted
+        :return: A list of (offset, length) tuples of complete records
+        """
+        boundaries = [0]
+        for i in range(1, num_ranges):
+            start = self.find_record_start(self.size * i // num_ranges)
+            if start > boundaries[-1]:
+                boundaries.append(start)
+        boundaries.append(self.size)
+        return [
+            (start, stop - start)
+            for start, stop in zip(boundaries, boundaries[1:])
+            if stop > start
+        ]
+
+    def ranges(self, range_size):
+        """
+        Lazily cut the file into ranges of about range_size bytes
+        :param range_size: The target size of every range
+        :return: A generator of (offset, length) tuples of complete records
+        """
+        start = 0
+        while start < self.size:
+            stop = self.find_record_start(start + range_size)
+            yield start, stop - start
+            start = stop
+
+    def blocks(self, offset, length, block_size=BLOCK_SIZE):
+        """
+        Yield zero-copy views of a range, cut at record starts into blocks
+        of roughly block_size bytes so memory use stays bounded. A mapped
+        file can only be closed once every view is released and the
+        generator is closed.
+        :param offset: The start of the range, at a record start
+        :param length: The length of the range in bytes
+        :param block_size: The target size of every block
+        """
+        end = offset + length
+        start = offset
+        with memoryview(self.data) as view:
+            while start < end:
+                stop = self.find_record_start(
+                    min(start + block_size, end), end
+                )
+                yield view[start:stop]
+                start = stop
+
+    def accumulate(self, offset, length, block_size=BLOCK_SIZE):
+        """
+        Calculate the per-position sums and counts of a range
+        :param offset: The start of the range, at a record start
+        :param length: The length of the range in bytes
+        :param block_size: The target size of the blocks decoded at once
+        :return: A PhredAccumulator for the range
+        """
+        accumulator = PhredAccumulator()
+        with contextlib.closing(
+            self.blocks(offset, length, block_size)
+        ) as blocks:
+            for block in blocks:
+                with block:
+                    add_mapped_block(accumulator, block)
+        return accumulator
+
+
+class BgzfRangeReader(FastqRangeReader):
+    """
+    Map a BGZF compressed FASTQ file into memory and hand out ranges of
+    whole compressed blocks. Records do not line up with blocks, so a
+    range owns the records that start inside its uncompressed data, and
+    reads on into the blocks that follow to complete the last one.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.offsets = None
+
+    def open(self):
+        """
+        Map the file into memory and find the start of every block, from
+        the .gzi index if there is one
+        """
+        super().open()
+        if self.offsets is None:
+            self.offsets = bgzf.read_index(self.path)
+        if self.offsets is None:
+            self.offsets = bgzf.block_offsets(self.data)
+
+    def find_record_start(self, position, end=None):
+        """
+        Snap a compressed byte offset forward to the next block start
+        :param position: A byte offset in the compressed file
+        :param end: Do not look past this offset, defaults to the file size
+        :return: The offset of the next block start, or end if there is none
+        """
+        end = self.size if end is None else end
+        index = bisect.bisect_left(self.offsets, position)
+        if index == len(self.offsets):
+            return end
+        return min(self.offsets[index], end)
+
+    def blocks(self, offset, length, block_size=BLOCK_SIZE):
+        """
+        Yield the uncompressed records that belong to a range of blocks.
+
+        A record belongs to the range its first line starts in, after
+        the first byte of the range, so the range that holds the line
+        break before it also owns it. A record start is only certain once
+        the line with its '+' separator is there, so blocks past the range
+        are added until the end of the last record is certain.
+        :param offset: The start of the range, at a block start
+        :param length: The compressed length of the range, up to a block
+        start or the end of the file
+        :param block_size: The target size of the uncompressed blocks
+        """
+        end = offset + length
+        data = bgzf.decompress_range(self.data, offset, length)
+        range_size = len(data)
+        following = end
+        while True:
+            records = FastqRangeReader(None, data)
+            if end >= self.size:
+                stop = records.size
+            else:
+                stop = records.find_record_start(range_size + 1)
+            if stop < records.size or following >= self.size:
+                break
+            block, size = bgzf.decompress_block(self.data, following)
+            data += block
+            following += size
+        start = 0 if offset == 0 else records.find_record_start(1, stop)
+        yield from records.blocks(start, stop - start, block_size)
+
+
+class FastqStream:
+    """
+    Read FASTQ data from a stream in blocks of complete records, so memory
+    use does not depend on the length of the stream.
+
+    The stream may start and end inside a record, like a block that GNU
+    parallel cut before a quality line starting with '@'. The bytes before
+    the first real record start are kept in head and an incomplete record
+    at the end in tail, so they can be joined with the neighbouring blocks
+    instead of being decoded from the wrong line.
+    """
+
+    def __init__(self, stream, block_size=STREAM_BLOCK_SIZE):
+        self.stream = stream
+        self.block_size = block_size
+        self.head = b""
+        self.tail = b""
+        # whether any record starts in the stream
+        self.aligned = False
+
+    def _find_start(self):
+        """
+        Read until the first real record start and keep what comes before
+        it in head
+        :return: The data read after the record start
+        """
+        buffer = b""
+        while True:
+            chunk = self.stream.read(self.block_size)
+            buffer += chunk
+            records = FastqRangeReader(None, buffer)
+            if records.is_record_start(0):
+                start = 0
+            else:
+                start = records.find_record_start(1)
+            if start < len(buffer):
+                self.aligned = True
+                self.head = buffer[:start]
+                return buffer[start:]
+            if not chunk:
+                self.head = buffer
+                return b""
+
+    def __iter__(self):
+        carry = self._find_start()
+        while self.aligned:
+            chunk = self.stream.read(self.block_size)
+            buffer = carry + chunk
+            end = records_end(buffer, at_eof=not chunk)
+            carry = buffer[end:]
+            if end:
+                yield buffer[:end]
+            if not chunk:
+                break
+        self.tail = carry
+
+
+# FUNCTIONS
+def open_range_reader(path):
+    """
+    Create the range reader that fits the format of a file
+    :param path: The path of a plain or BGZF compressed FASTQ file
+    :return: A BgzfRangeReader or a FastqRangeReader
+    """
+    if bgzf.is_bgzf(path):
+        return BgzfRangeReader(path)
+    return FastqRangeReader(path)
+
+
+def is_mappable(file):
+    """
+    Check whether an opened input file is a regular file that can be split
+    into ranges; plain gzip files can only be read as a stream
+    :param file: An open file object, for example from argparse.FileType
+    :return: True if the file can be read with open_range_reader
+    """
+    try:
+        if not (os.path.isfile(file.name) and file.seekable()):
+            return False
+    except (AttributeError, TypeError, ValueError):
+        return False
+    return not bgzf.is_gzip(file.name) or bgzf.is_bgzf(file.name)
+
+
+def accumulate_range(path, offset, length):
+    """
+    Open a file and calculate the per-position sums and counts of a range,
+    meant to be called in a worker process
+    :param path: The path of the FASTQ file, which may be BGZF compressed
+    :param offset: The start of the range, at a record or block start
+    :param length: The length of the range in bytes
+    :return: A PhredAccumulator for the range
+    """
+    with open_range_reader(path) as reader:
+        return reader.accumulate(offset, length)
+
+
+def add_mapped_block(accumulator, block):
+    """
+    Add a block of a mapped file to an accumulator. The frames of an error
+    raised while decoding hold arrays over the map, which keep the block
+    and the map from being released, so their locals are cleared before
+    the error is passed on.
+    :param accumulator: A PhredAccumulator
+    :param block: A view from FastqRangeReader.blocks
+    :return: The accumulator
+    """
+    try:
+        return accumulator.add_block(block)
+    except Exception as error:
+        traceback.clear_frames(error.__traceback__)
+        raise
+
+
+def page_in(buffer):
+    """
+    Read one byte of every page of a buffer, so the pages of a mapped file
+    are read from disk now instead of while the buffer is decoded. Data
+    that is already in memory costs next to nothing.
+    :param buffer: A bytes-like object, like a block of a FastqRangeReader
+    :return: The sum of the bytes that were read
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size == 0:
+        return 0
+    # the stride may stop short of the last page
+    return int(data[:: mmap.PAGESIZE].sum()) + int(data[-1])
+
+
+def records_end(buffer, at_eof=False):
+    """
+    Find where the last complete four-line record of a buffer ends
+    :param buffer: Bytes that start at a record start
+    :param at_eof: Whether the buffer ends the stream, in which case the
+    last line of a record does not need a newline
+    :return: The offset just past the last complete record
+    """
+    # the lines after the last multiple of four belong to a record that
+    # continues after the buffer
+    partial_lines = buffer.count(b"\n") % 4
+    if at_eof and partial_lines == 3 and not buffer.endswith(b"\n"):
+        return len(buffer)
+    end = len(buffer)
+    for _ in range(partial_lines + 1):
+        end = buffer.rfind(b"\n", 0, end)
+    return end + 1
+
+
+def accumulate_stream(stream, block_size=STREAM_BLOCK_SIZE):
+    """
+    Calculate the per-position sums and counts of a stream of whole FASTQ
+    records, decoding one block at a time
+    :param stream: A binary file object
+    :param block_size: The number of bytes to read at once
+    :return: A PhredAccumulator for the stream
+    """
+    records = FastqStream(stream, block_size)
+    accumulator = PhredAccumulator()
+    for block in records:
+        accumulator.add_block(block)
+    if records.head or records.tail:
+        raise ValueError("The stream starts or ends inside a FASTQ record")
+    return accumulator
@@ -0,0 +1,371 @@
+"""
+Synthetic FASTQ data for tests and benchmarks.
+
+Records are built a batch at a time in one uint8 buffer with numpy:
+reads of one length as the rows of a matrix, reads of different lengths
+with boolean masks of where the sequence and quality lines go. Random
+bytes are turned into bases and qualities with bytes.translate, so no
+Python code runs per record or per base. The same seed and settings
+always give the same bytes.
+"""
+
+# IMPORTS
+import gzip
+import statistics
+import sys
+
+import numpy as np
+
+from phredlib.bgzf import BgzfWriter
+
+# CONSTANTS
+DISTRIBUTIONS = ["fixed", "variable", "long"]
+PROFILES = ["illumina", "uniform", "nanopore"]
+COMPRESSIONS = ["none", "gzip", "bgzf"]
+# bases generated per batch, which bounds the memory use
+BATCH_BASES = 8 * 1024 * 1024
+MIN_QUALITY = 2
+MAX_QUALITY = 41
+HEADER_PREFIX = b"@syn."
+ID_DIGITS = 10
+# a random byte to a base
+BASE_TABLE = bytes(b"ACGT"[i % 4] for i in range(256))
+# the mean quality and its standard deviation of the profiles; the mean
+# of the illumina profile drops by 1 every 20 bases
+PROFILE_MEAN = {"illumina": 37, "nanopore": 13}
+PROFILE_SD = {"illumina": 3, "nanopore": 4}
+ILLUMINA_DROP = 20
+
+
+# CLASSES
+class FastqGenerator:
+    """
+    Generate random FASTQ records.
+
+    The read lengths follow one of DISTRIBUTIONS: every read the same
+    length, normally distributed around it, or log-normally distributed
+    like long reads. The qualities follow one of PROFILES. A fraction of
+    the records can be made tricky: their quality line starts with '@',
+    so it looks like a header line to a tool that splits on '@'.
+    """
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(
+        self,
+        seed=None,
+        read_length=150,
+        distribution="fixed",
+        length_sd=None,
+        profile="illumina",
+        tricky=0.0,
+    ):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(
+                f"Unknown read length distribution {distribution}"
+            )
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown quality profile {profile}")
+        self.rng = np.random.default_rng(seed)
+        self.read_length = read_length
+        self.distribution = distribution
+        self.length_sd = length_sd
+        self.profile = profile
+        self.tricky = tricky
+        self.num_reads = 0
+        self.table = self.quality_table(profile)
+
+    @staticmethod
+    def quality_table(profile):
+        """
+        Build the table that turns a random byte into a quality character
+        at the start of a read, for bytes.translate
+        :param profile: One of PROFILES
+        :return: A bytes object of 256 quality characters
+        """
+        fractions = (np.arange(256) + 0.5) / 256
+        if profile == "uniform":
+            scores = MIN_QUALITY + np.floor(
+                fractions * (MAX_QUALITY - MIN_QUALITY + 1)
+            )
+        else:
+            # the quantiles of a normal distribution in 256 equal parts
+            normal = statistics.NormalDist(
+                PROFILE_MEAN[profile], PROFILE_SD[profile]
+            )
+            scores = np.clip(
+                np.rint([normal.inv_cdf(fraction) for fraction in fractions]),
+                MIN_QUALITY,
+                MAX_QUALITY,
+            )
+        return (scores + 33).astype(np.uint8).tobytes()
+
+    def lengths(self, num_reads):
+        """
+        Draw the lengths of a batch of reads
+        :param num_reads: The number of reads
+        :return: An int64 array of lengths of at least 1
+        """
+        if self.distribution == "fixed":
+            return np.full(num_reads, self.read_length, dtype=np.int64)
+        if self.distribution == "variable":
+            sd = self.length_sd or self.read_length / 10
+            lengths = self.rng.normal(self.read_length, sd, num_reads)
+        else:
+            # the read length is the median, length_sd the sigma of the log
+            sigma = self.length_sd or 0.8
+            lengths = self.rng.lognormal(
+                np.log(self.read_length), sigma, num_reads
+            )
+        return np.maximum(np.rint(lengths), 1).astype(np.int64)
+
+    def random_text(self, shape, table):
+        """
+        Draw random characters
+        :param shape: The shape of the array
+        :param table: A bytes.translate table from a random byte to a
+        character
+        :return: A uint8 array of characters
+        """
+        size = int(np.prod(shape))
+        text = self.rng.bytes(size).translate(table)
+        return np.frombuffer(text, dtype=np.uint8).reshape(shape)
+
+    def qualities(self, shape, drops=None):
+        """
+        Draw quality characters
+        :param shape: The shape of the array
+        :param drops: How much lower the quality of every base is than at
+        the start of its read, which may be broadcast to shape
+        :return: A uint8 array of quality characters
+        """
+        quality = self.random_text(shape, self.table)
+        if drops is None:
+            return quality
+        # the lowest character in the table is far enough above the floor
+        # that this can not wrap around
+        return np.maximum(quality - drops, MIN_QUALITY + 33)
+
+    @staticmethod
+    def illumina_drops(lengths):
+        """
+        Calculate the drop in quality of every base of the illumina profile,
+        one step every ILLUMINA_DROP bases, per stretch of equal drop
+        instead of per base
+        :param lengths: The length of every read
+        :return: A uint8 array with the drop of every base
+        """
+        steps = -(-lengths // ILLUMINA_DROP)
+        ends = np.cumsum(steps)
+        # the number of every stretch inside its read
+        stretch = np.arange(ends[-1]) - np.repeat(ends - steps, steps)
+        sizes = np.full(ends[-1], ILLUMINA_DROP)
+        sizes[ends - 1] = lengths - ILLUMINA_DROP * (steps - 1)
+        drops = np.minimum(stretch, PROFILE_MEAN["illumina"] - MIN_QUALITY)
+        return np.repeat(drops.astype(np.uint8), sizes)
+
+    def batch(self, num_reads):
+        """
+        Generate a batch of records
+        :param num_reads: The number of records
+        :return: A tuple of a uint8 array with the FASTQ text and the end
+        offset of every record in it
+        """
+        lengths = self.lengths(num_reads)
+        header = len(HEADER_PREFIX) + ID_DIGITS + 1
+        # header, sequence + newline, '+' + newline, quality + newline
+        sizes = header + 2 * lengths + 4
+        ends = np.cumsum(sizes)
+
+        # the header: a prefix and the zero padded number of the read
+        ids = self.num_reads + np.arange(num_reads, dtype=np.int64)
+        powers = 10 ** np.arange(ID_DIGITS - 1, -1, -1, dtype=np.int64)
+        headers = np.empty((num_reads, header), dtype=np.uint8)
+        headers[:, : len(HEADER_PREFIX)] = np.frombuffer(
+            HEADER_PREFIX, dtype=np.uint8
+        )
+        headers[:, len(HEADER_PREFIX) : -1] = ids[:, None] // powers % 10 + 48
+        headers[:, -1] = ord("\n")
+        tricky = self.rng.random(num_reads) < self.tricky
+
+        if self.distribution == "fixed":
+            text = self._fixed_batch(headers, lengths[0], tricky)
+        else:
+            text = self._variable_batch(headers, lengths, ends - sizes, tricky)
+        self.num_reads += num_reads
+        return text, ends
+
+    def _fixed_batch(self, headers, length, tricky):
+        """
+        Lay out records of the same length as the rows of a matrix
+        :param headers: The header lines of the records
+        :param length: The length of every read
+        :param tricky: A mask of the records to make tricky
+        :return: A flat uint8 array with the FASTQ text
+        """
+        num_reads, header = headers.shape
+        text = np.empty((num_reads, header + 2 * length + 4), dtype=np.uint8)
+        text[:, :header] = headers
+        text[:, header : header + length] = self.random_text(
+            (num_reads, length), BASE_TABLE
+        )
+        text[:, header + length : header + length + 3] = np.frombuffer(
+            b"\n+\n", dtype=np.uint8
+        )
+        quality = text[:, header + length + 3 : -1]
+        drops = None
+        if self.profile == "illumina":
+            drops = self.illumina_drops(np.array([length]))
+        quality[:] = self.qualities((num_reads, length), drops)
+        quality[tricky, 0] = ord("@")
+        text[:, -1] = ord("\n")
+        return text.reshape(-1)
+
+    def _variable_batch(self, headers, lengths, starts, tricky):
+        """
+        Lay out records of different lengths. A running sum over markers at
+        the start and end of every sequence and quality line tells for
+        every byte of the text what it holds, so each part can be filled
+        in with one boolean mask.
+        :param headers: The header lines of the records
+        :param lengths: The length of every read
+        :param starts: The offset of every record in the text
+        :param tricky: A mask of the records to make tricky
+        :return: A flat uint8 array with the FASTQ text
+        """
+        num_reads, header = headers.shape
+        num_bases = int(lengths.sum())
+        total = num_reads * (header + 4) + 2 * num_bases
+        sequence_starts = starts + header
+        quality_starts = sequence_starts + lengths + 3
+        markers = np.zeros(total + 1, dtype=np.int8)
+        markers[sequence_starts] = 1
+        markers[sequence_starts + lengths] = -1
+        markers[quality_starts] = 2
+        markers[quality_starts + lengths] = -2
+        # 0 for the header and line ends, 1 for bases, 2 for qualities
+        kind = np.cumsum(markers[:-1], dtype=np.int8)
+
+        text = np.empty(total, dtype=np.uint8)
+        fixed = np.empty((num_reads, header + 4), dtype=np.uint8)
+        fixed[:, :header] = headers
+        fixed[:, header:] = np.frombuffer(b"\n+\n\n", dtype=np.uint8)
+        text[kind == 0] = fixed.reshape(-1)
+        text[kind == 1] = self.random_text(num_bases, BASE_TABLE)
+        drops = None
+        if self.profile == "illumina":
+            drops = self.illumina_drops(lengths)
+        text[kind == 2] = self.qualities(num_bases, drops)
+        text[quality_starts[tricky]] = ord("@")
+        return text
+
+    def chunks(self, num_reads=None, num_bytes=None):
+        """
+        Generate FASTQ text until a number of reads or bytes is reached
+        :param num_reads: The number of reads to generate
+        :param num_bytes: The size to stop at; the last record that fits
+        is the last one, but there is always at least one record
+        :return: A generator of bytes-like objects of whole records
+        """
+        if num_reads is None and num_bytes is None:
+            raise ValueError("Give a number of reads or a number of bytes")
+        reads_left = num_reads
+        bytes_left = num_bytes
+        first = True
+        while (reads_left is None or reads_left > 0) and (
+            bytes_left is None or bytes_left > 0
+        ):
+            size = max(1, BATCH_BASES // self.read_length)
+            if reads_left is not None:
+                size = min(size, reads_left)
+            text, ends = self.batch(size)
+            if bytes_left is not None and ends[-1] > bytes_left:
+                keep = int(np.searchsorted(ends, bytes_left, side="right"))
+                if first:
+                    keep = max(keep, 1)
+                # forget the reads that do not fit
+                self.num_reads -= size - keep
+                if keep:
+                    yield text[: ends[keep - 1]]
+                return
+            first = False
+            if bytes_left is not None:
+                bytes_left -= len(text)
+            if reads_left is not None:
+                reads_left -= size
+            yield text
+
+    def write(self, file, num_reads=None, num_bytes=None):
+        """
+        Write FASTQ text to an open binary file
+        :param file: A binary file object
+        :param num_reads: The number of reads to write
+        :param num_bytes: The size to stop at, see chunks
+        :return: The number of bytes written
+        """
+        written = 0
+        for chunk in self.chunks(num_reads, num_bytes):
+            file.write(memoryview(chunk))
+            written += len(chunk)
+        return written
+
+
+# FUNCTIONS
+def compression_for(path):
+    """
+    Guess the compression from the extension of a path
+    :param path: The output path
+    :return: One of COMPRESSIONS
+    """
+    if path.endswith((".bgz", ".bgzf")):
+        return "bgzf"
+    if path.endswith(".gz"):
+        return "gzip"
+    return "none"
+
+
+# pylint: disable-next=too-many-arguments
+def write_fastq(
+    path,
+    num_reads=None,
+    num_bytes=None,
+    compression=None,
+    level=1,
+    threads=1,
+    **settings,
+):
+    """
+    Write a synthetic FASTQ file
+    :param path: The output path, or '-' for stdout
+    :param num_reads: The number of reads to write
+    :param num_bytes: The uncompressed size to stop at
+    :param compression: One of COMPRESSIONS; by default taken from the
+    extension of path. A BGZF file gets a .gzi index
+    :param level: The compression level
+    :param threads: The number of threads that compress BGZF blocks
+    :param settings: The settings of the FastqGenerator
+    :return: A tuple of the number of reads and uncompressed bytes
+    """
+    generator = FastqGenerator(**settings)
+    if compression is None:
+        compression = compression_for(path)
+    if compression == "bgzf":
+        if path == "-":
+            raise ValueError("BGZF output needs a path to write the index")
+        with BgzfWriter(path, level, index=True, threads=threads) as file:
+            written = generator.write(file, num_reads, num_bytes)
+    elif path == "-":
+        if compression == "gzip":
+            with gzip.GzipFile(
+                fileobj=sys.stdout.buffer, mode="wb", compresslevel=level
+            ) as file:
+                written = generator.write(file, num_reads, num_bytes)
+        else:
+            written = generator.write(sys.stdout.buffer, num_reads, num_bytes)
+        sys.stdout.buffer.flush()
+    elif compression == "gzip":
+        with gzip.open(path, "wb", compresslevel=level) as file:
+            written = generator.write(file, num_reads, num_bytes)
+    else:
+        with open(path, "wb") as file:
+            written = generator.write(file, num_reads, num_bytes)
+    return generator.num_reads, written
@@ -0,0 +1,206 @@
+"""
+Adaptive batch sizing.
+
+The first few batches of a run are sent out one at a time. Their compute
+time (measured by the worker) and round trip time (measured by the
+producer) give the cost per read and the fixed IPC overhead per task,
+from which a batch size is picked that makes every task take a target
+duration.
+"""
+
+# IMPORTS
+import argparse
+import itertools
+import logging
+import threading
+import time
+
+# CONSTANTS
+TARGET_MIN = 0.05
+TARGET_MAX = 0.2
+# keep the IPC overhead below this fraction of a task
+OVERHEAD_FRACTION = 0.05
+MAX_BATCH_BYTES = 32 * 1024 * 1024
+NUM_PROBES = 3
+
+logger = logging.getLogger(__name__)
+
+
+# CLASSES
+class BatchSizer:
+    """
+    Pick a batch size from the timings of a few probe batches.
+
+    Sizes are expressed in items, which are reads for batches of quality
+    lines and bytes for byte ranges of a file.
+    """
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(
+        self,
+        initial_size,
+        num_workers=1,
+        total=None,
+        unit="reads",
+        num_probes=NUM_PROBES,
+        target=(TARGET_MIN, TARGET_MAX),
+        max_bytes=MAX_BATCH_BYTES,
+    ):
+        self.batch_size = initial_size
+        self.num_workers = num_workers
+        self.total = total
+        self.unit = unit
+        self.num_probes = num_probes
+        self.target = target
+        self.max_bytes = max_bytes
+        self.samples = []
+        self.reason = None
+        self._started = None
+        self._answered = threading.Event()
+
+    @property
+    def probing(self):
+        """
+        Whether the sizer is still measuring probe batches
+        :return: True until enough probes are recorded
+        """
+        return self.reason is None
+
+    def start(self, num_items, num_bytes):
+        """
+        Mark that a probe batch is handed out right now
+        :param num_items: The number of reads (or bytes) in the batch
+        :param num_bytes: The size of the batch in bytes
+        """
+        self._answered.clear()
+        self._started = (num_items, num_bytes, time.perf_counter())
+
+    def wait(self):
+        """
+        Block until the result of the current probe batch is recorded
+        """
+        self._answered.wait()
+
+    def record(self, compute_time):
+        """
+        Record the result of the current probe batch
+        :param compute_time: The seconds the worker spent computing
+        """
+        num_items, num_bytes, started = self._started
+        round_trip = time.perf_counter() - started
+        self.samples.append((num_items, num_bytes, compute_time, round_trip))
+        if len(self.samples) >= self.num_probes:
+            self.batch_size, self.reason = self.choose()
+            logger.info(
+                "batch size %d %s: %s", self.batch_size, self.unit, self.reason
+            )
+        self._answered.set()
+
+    def skip(self):
+        """
+        Give up on the current probe batch without recording it, because
+        its job failed; the next batch is probed instead
+        """
+        self._answered.set()
+
+    def cancel(self):
+        """
+        Stop probing for good, because the run is aborted. A producer
+        waiting for the result of a probe batch goes on without it and
+        does not wait for any later batch.
+        """
+        self.reason = "cancelled"
+        self._answered.set()
+
+    def choose(self):
+        """
+        Calculate the batch size from the recorded probes
+        :return: A tuple of the batch size and the reason it was chosen
+        """
+        items = sum(sample[0] for sample in self.samples)
+        num_bytes = sum(sample[1] for sample in self.samples)
+        compute = sum(sample[2] for sample in self.samples)
+        overhead = sum(
+            max(sample[3] - sample[2], 0.0) for sample in self.samples
+        ) / len(self.samples)
+
+        per_item = max(compute / max(items, 1), 1e-12)
+        bytes_per_item = max(num_bytes / max(items, 1), 1e-12)
+        target = min(
+            max(overhead / OVERHEAD_FRACTION, self.target[0]), self.target[1]
+        )
+        size = target / per_item
+        reason = (
+            f"compute {per_item * 1e6:.2f} us/{self.unit[:-1]}, overhead "
+            f"{overhead * 1e3:.2f} ms/task, target {target * 1e3:.0f} ms/task"
+        )
+        if size * bytes_per_item > self.max_bytes:
+            size = self.max_bytes / bytes_per_item
+            reason += f", capped at {self.max_bytes // 2**20} MB per batch"
+        if self.total is not None and size * self.num_workers > self.total:
+            size = -(-self.total // self.num_workers)
+            reason += f", capped to keep {self.num_workers} workers busy"
+        return max(int(size), 1), reason
+
+
+# FUNCTIONS
+def adaptive_batches(iterator, sizer):
+    """
+    Batch an iterator with the size picked by a BatchSizer. Probe batches
+    are handed out one at a time: after yielding one, the generator waits
+    until its result is recorded with sizer.record, so the consumer of the
+    results must run in another thread than the consumer of the batches.
+    :param iterator: Any iterator, for example of quality lines
+    :param sizer: A BatchSizer
+    :return: A generator of lists
+    """
+    iterator = iter(iterator)
+    while True:
+        probing = sizer.probing
+        batch = list(itertools.islice(iterator, sizer.batch_size))
+        if not batch:
+            return
+        if probing:
+            sizer.start(len(batch), sum(len(item) for item in batch))
+        yield batch
+        if probing:
+            sizer.wait()
+
+
+def adaptive_ranges(reader, sizer):
+    """
+    Cut a mapped FASTQ file into byte ranges with the size picked by a
+    BatchSizer, probing the same way as adaptive_batches
+    :param reader: An open FastqRangeReader
+    :param sizer: A BatchSizer with sizes in bytes
+    :return: A generator of (offset, length) tuples of complete records
+    """
+    start = 0
+    while start < reader.size:
+        probing = sizer.probing
+        stop = reader.find_record_start(start + sizer.batch_size)
+        if probing:
+            sizer.start(stop - start, stop - start)
+        yield start, stop - start
+        if probing:
+            sizer.wait()
+        start = stop
+
+
+def parse_batch_size(value):
+    """
+    Argparse type for a batch size that may also be 'auto'
+    :param value: The command line value
+    :return: A positive int, or the string 'auto'
+    """
+    if value == "auto":
+        return value
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise argparse.ArgumentTypeError(
+            f"batch size must be a positive number or 'auto', not {value!r}"
+        )
+    return size